@@ -0,0 +1,224 @@
+# Approximate substring search in a long text, in process
+#
+# Replaces the tre-agrep call of hl_fulltext_align.fuzzy_search, with
+# the same options: literal pattern, whole words only and the costs
+# below. The text is prepared once, then searched for any number of
+# patterns.
+import time
+import numpy as np
+
+INSERT_COST = 1      # a character of the text missing in the pattern
+DELETE_COST = 1      # a character of the pattern missing in the text
+SUBSTITUTE_COST = 3  # more than a delete plus an insert, i.e. never cheaper
+INF = 1 << 28        # cost of the cells no alignment can reach
+
+QGRAM = 8              # length of the exact seeds of Matcher.find
+MAX_OCCURRENCES = 50   # q-grams more frequent in the text are not used as seeds
+MAX_WINDOWS = 4        # most seeded windows searched per pattern
+CHECK_ROWS = 16        # DP rows between two checks of the deadline
+
+
+def qgram_keys(codes, q=QGRAM):
+    """Hash of the q-gram starting at each position of codes
+
+    >>> codes = np.frombuffer("abcabc".encode('utf-32-le'), dtype=np.uint32)
+    >>> keys = qgram_keys(codes, 3)
+    >>> len(keys), bool(keys[0] == keys[3]), bool(keys[0] == keys[1])
+    (4, True, False)
+    """
+    n = len(codes) - q + 1
+    keys = np.zeros(max(n, 0), dtype=np.uint64)
+    for k in range(q if n > 0 else 0):
+        # Wraps around, collisions only cost a useless window
+        keys = keys * np.uint64(1000003) + codes[k:k+n].astype(np.uint64)
+    return keys
+
+
+class Matcher:
+    """Find the cheapest approximate occurrence of a pattern in text
+
+    Costs are edit distances with the costs above. Like ``agrep
+    --word-regexp`` a match starts at the beginning of the text or
+    after a non-word character (word characters are letters, digits
+    and '_'), and ends at the end of the text or before a non-word
+    character. Positions are character offsets into text.
+
+    >>> m = Matcher("hello world xxx")
+    >>> m.search("word", 10)
+    (6, 11, 1)
+    >>> m.search("hello", 0)
+    (0, 5, 0)
+    >>> m.search("ell", 10)
+    (0, 5, 2)
+    >>> m.search("zzzz", 3) is None
+    True
+    """
+    def __init__(self, text):
+        self.text = text
+        self.codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        word = np.array([c.isalnum() or c == '_' for c in text], dtype=bool)
+        # Over the positions 0..len(text) between the characters
+        self.word_start = np.ones(len(text) + 1, dtype=bool)
+        self.word_start[1:] = ~word
+        self.word_end = np.ones(len(text) + 1, dtype=bool)
+        self.word_end[:-1] = ~word
+        self.penalties = {}
+        # q-gram index, built by the first find
+        self.qgram_order = None
+        self.qgram_sorted = None
+
+    def __len__(self):
+        return len(self.text)
+
+    def penalty(self, char):
+        """Cost of aligning char to each character of the text, 0 or SUBSTITUTE_COST"""
+        if char not in self.penalties:
+            self.penalties[char] = np.where(self.codes == ord(char), 0, SUBSTITUTE_COST).astype(np.int8)
+        return self.penalties[char]
+
+    def search(self, pattern, max_dist, lo=0, hi=None, deadline=None):
+        """(start, end, cost) of the cheapest match of pattern in text[lo:hi]
+
+        None if every match costs more than max_dist. Ties go to the
+        match ending first, then to the shortest one. Raises TimeoutError
+        once time.monotonic() passes deadline (None for no limit).
+
+        The costs of the matches ending at every position come from a
+        dynamic programming over the pattern, one numpy row over the
+        text per pattern character, stopped early once every cell of a
+        row costs more than max_dist. The start of the best match is
+        then found by the same search backwards from its end, over
+        the few characters a match can span.
+        """
+        hi = len(self.text) if hi is None else hi
+        cost = np.where(self.word_start[lo:hi+1], 0, INF).astype(np.int32)
+        cost = _align(lambda char: self.penalty(char)[lo:hi], pattern, cost, max_dist, deadline)
+        if cost is None:
+            return None
+        cost = np.where(self.word_end[lo:hi+1], cost, INF)
+        end = lo + int(np.argmin(cost))
+        dist = int(cost[end - lo])
+        if dist > max_dist:
+            return None
+
+        first = max(lo, end - len(pattern) - dist // INSERT_COST)
+        # Position r of the backward rows is end - r
+        cost = np.full(end - first + 1, INF, dtype=np.int32)
+        cost[0] = 0
+        cost = _align(lambda char: self.penalty(char)[first:end][::-1], pattern[::-1], cost, dist, deadline)
+        cost = np.where(self.word_start[first:end+1][::-1], cost, INF)
+        return end - int(np.argmin(cost)), end, dist
+
+    def candidate_windows(self, pattern, max_dist):
+        """Ranges (lo, hi) of the text sharing exact q-grams with pattern
+
+        Every q-gram of the pattern occurring at most MAX_OCCURRENCES
+        times in the text is a seed. A seed puts the pattern at offset
+        text position - pattern position (its diagonal). The bands of
+        max_dist diagonals with the most seeds are the candidates, at
+        most MAX_WINDOWS of them and more than max_dist apart. The
+        window of a band is the band widened by the pattern and
+        max_dist, about len(pattern) + 2 * max_dist characters, so a
+        long chain of seeds on repetitive text never gives a large
+        window.
+        """
+        if self.qgram_order is None:
+            keys = qgram_keys(self.codes)
+            self.qgram_order = np.argsort(keys, kind='stable')
+            self.qgram_sorted = keys[self.qgram_order]
+        keys = qgram_keys(np.frombuffer(pattern.encode('utf-32-le'), dtype=np.uint32))
+        first = np.searchsorted(self.qgram_sorted, keys, 'left')
+        count = np.searchsorted(self.qgram_sorted, keys, 'right') - first
+        seeds = np.flatnonzero((count > 0) & (count <= MAX_OCCURRENCES))
+        if len(seeds) == 0:
+            return []
+
+        # All (text position, pattern position) pairs of the seeds
+        count = count[seeds]
+        hits = np.arange(count.sum()) + np.repeat(first[seeds] - np.cumsum(count) + count, count)
+        diagonals = np.sort(self.qgram_order[hits] - np.repeat(seeds, count))
+        # Seeds in the band [diagonals[i], diagonals[i] + max_dist]
+        dense = np.searchsorted(diagonals, diagonals + max_dist, 'right') - np.arange(len(diagonals))
+        bands = []
+        for i in np.argsort(-dense, kind='stable').tolist():
+            if all(abs(diagonals[i] - band) > max_dist for band in bands):
+                bands.append(diagonals[i])
+                if len(bands) == MAX_WINDOWS:
+                    break
+        return [(max(0, int(band) + max_dist // 2 - max_dist),
+                 min(len(self.text), int(band) + max_dist // 2 + len(pattern) + max_dist))
+                for band in bands]
+
+    def find(self, pattern, max_dist, deadline=None):
+        """search, only inside the candidate_windows of pattern
+
+        Gives the result of search unless a match is found in the
+        windows while a cheaper one shares no q-gram with the pattern or
+        lies outside the windows. Without any seed (e.g. a pattern
+        shorter than QGRAM) or without any match in the windows, the
+        whole text is searched, so a pattern search finds is never
+        missed. For the patterns found in their windows, the cost grows
+        with the length of the pattern rather than with the length of
+        the text. deadline is the one of search.
+
+        >>> m = Matcher("the quick brown fox jumps over the lazy dog")
+        >>> m.find("quick browne fox", 10)
+        (4, 19, 1)
+        >>> m.find("quick browne fox", 10) == m.search("quick browne fox", 10)
+        True
+        >>> m = Matcher("abcdefgh zzz " + "q " * 100 + "abcdXfgh xy")
+        >>> m.candidate_windows("abcdefgh xy", 2), m.find("abcdefgh xy", 2)
+        ([(0, 14)], (213, 224, 2))
+        """
+        windows = self.candidate_windows(pattern, max_dist)
+        if len(windows) == 0:
+            return self.search(pattern, max_dist, deadline=deadline)
+        best = None
+        for lo, hi in windows:
+            res = self.search(pattern, max_dist, lo, hi, deadline)
+            # Same order as search: lowest cost, then first end
+            if res is not None and (best is None or (res[2], res[1]) < (best[2], best[1])):
+                best = res
+        if best is None:
+            return self.search(pattern, max_dist, deadline=deadline)
+        return best
+
+
+def _align(penalty, pattern, cost, max_dist, deadline=None):
+    """Last row of the edit distance DP of pattern against a text
+
+    Args:
+        penalty: function of a pattern character, giving its substitution
+                 cost against each character of the text
+        cost: costs of the empty pattern at each position (0 where a match
+              may start, INF elsewhere)
+        deadline: time.monotonic() value after which to raise TimeoutError,
+                  checked every CHECK_ROWS rows
+
+    Returns:
+        cost of the cheapest alignment of pattern ending at each position,
+        None if they all cost more than max_dist
+    """
+    steps = np.arange(len(cost), dtype=np.int32) * INSERT_COST
+    cost = _insert(cost, steps)
+    for i, char in enumerate(pattern):
+        if deadline is not None and i % CHECK_ROWS == 0 and time.monotonic() > deadline:
+            raise TimeoutError('Timeout')
+        # A pattern character is matched, substituted or deleted
+        diag = cost[:-1] + penalty(char)
+        cost += DELETE_COST
+        np.minimum(cost[1:], diag, out=cost[1:])
+        cost = _insert(cost, steps)
+        if cost.min() > max_dist:
+            return None
+    return cost
+
+
+def _insert(cost, steps):
+    """Extend the alignments of a DP row by any number of text characters
+
+    The new cost at j is min over k <= j of cost[k] + (j - k) * INSERT_COST.
+    """
+    cost = np.minimum.accumulate(cost - steps)
+    cost += steps
+    return cost
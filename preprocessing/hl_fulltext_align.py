@@ -11,19 +11,19 @@
 
 from bs4 import BeautifulSoup
 import csv
-import tempfile
-import subprocess
 import re
 import doctest
 import math
 import os
 # Need to install nltk and then download nltk.download('punkt')
 import nltk
-import signal
 import time
 import argparse
+import functools
 
 from full_text_html_extract import html2text
+from approx_match import Matcher
+from offset_map import OffsetMap
 
 def devide_string(string, num_interval):
     """Devide string into intervals
@@ -46,7 +46,7 @@ def devide_string(string, num_interval):
         return res
 
 
-def fuzzy_search_wrapper(string, pattern, max_dist=100):
+def fuzzy_search_wrapper(string, pattern, max_dist=100, deadline=None):
     # I'm going to determine the distance. It seems that 1000
     # character tempt to have 150 errors. For those with a lot of
     # <a>s, there will be more. So it is probabaly desired to use 1/5
@@ -72,7 +72,7 @@ def fuzzy_search_wrapper(string, pattern, max_dist=100):
         # max_dist (better), because that should meant to be the total
         # distance for all intervals, to keep the interface
         # consistent. But this is not so important.
-        fuzz_res = fuzzy_search(string, p, max_dist=max_dist)
+        fuzz_res = fuzzy_search(string, p, max_dist=max_dist, deadline=deadline)
         # we need to find all of them to be valid
         if not fuzz_res: return None
         begin, end, d = fuzz_res
@@ -92,45 +92,39 @@ def fuzzy_search_wrapper(string, pattern, max_dist=100):
     else:
         return res[0][0], res[0][1], res_d
     
-class timeout:
-    def __init__(self, seconds=1, error_message='Timeout'):
-        self.seconds = seconds
-        self.error_message = error_message
-    def handle_timeout(self, signum, frame):
-        raise TimeoutError(self.error_message)
-    def __enter__(self):
-        signal.signal(signal.SIGALRM, self.handle_timeout)
-        signal.alarm(self.seconds)
-    def __exit__(self, type, value, traceback):
-        signal.alarm(0)
-
-        
-def fuzzy_search_timeout(string, pattern, max_dist=100):
-    sec = math.ceil(len(pattern) / 500)
-    with timeout(seconds=sec):
-        try:
-            res = fuzzy_search_wrapper(string, pattern, max_dist=max_dist)
-            return res
-        except TimeoutError:
-            print('timeout')
-            return None
-        
-        
+def fuzzy_search_timeout(string, pattern, max_dist=100, seconds=None):
+    """fuzzy_search_wrapper, None if it takes more than seconds
+
+    seconds: time budget (a float), default one second per 500
+    characters of the pattern
+
+    The matcher checks the deadline itself as it goes, so unlike
+    signal.alarm this works in any thread and below one second.
+    """
+    if seconds is None:
+        seconds = math.ceil(len(pattern) / 500)
+    try:
+        return fuzzy_search_wrapper(string, pattern, max_dist=max_dist,
+                                    deadline=time.monotonic() + seconds)
+    except TimeoutError:
+        print('timeout')
+        return None
+
+
+# max_dist of the configurations tried by fuzzy_search_multi
+MAX_DISTS = (100, 120, 150, 200)
+
 def fuzzy_search_multi(string, pattern):
-    """Run agrep with multiple distance configuration. Return as long as
-    one of them succeeds.
+    """Search with multiple distance configuration (MAX_DISTS). Return as
+    long as one of them succeeds.
+
+    fuzzy_search returns the cheapest match whatever max_dist, so a chunk
+    of cost d is found the same by every configuration with max_dist >= d,
+    and the first configuration to succeed gives what a single search with
+    the largest max_dist gives. That single search is done instead of one
+    search per configuration.
     """
-    # try 100, 120, 150, 200
-    res = fuzzy_search_timeout(string, pattern, max_dist=100)
-    if res:
-        return res
-    res = fuzzy_search_timeout(string, pattern, max_dist=120)
-    if res:
-        return res
-    res = fuzzy_search_timeout(string, pattern, max_dist=150)
-    if res:
-        return res
-    res = fuzzy_search_timeout(string, pattern, max_dist=200)
+    res = fuzzy_search_timeout(string, pattern, max_dist=max(MAX_DISTS))
     if res:
         return res
     print('warning: cannot find "' +
@@ -141,60 +135,32 @@ def fuzzy_search_multi(string, pattern):
 
     
     
-# implement tre_search using subprocess call to agrep.  When the
-# string is long, it might be imprecise. For an example, for 42, use
-# the last highlight. It says the distance is 7 (which means perfect
-# alignment), but the returned string is not aligned.
-def fuzzy_search(string, pattern, max_dist=120):
+@functools.lru_cache(maxsize=4)
+def text_matcher(string):
+    """Matcher (and q-gram index) of string, prepared once for all the
+    highlights searched in it
+    """
+    return Matcher(string)
+
+
+# Same search as the former subprocess call of
+#   tre-agrep -E max_dist --literal --word-regexp --show-cost
+#             --delete-cost=1 --insert-cost=1 --substitute-cost=3
+# done in process by approx_match.Matcher, only around the places
+# sharing exact q-grams with the pattern (see Matcher.find).
+def fuzzy_search(string, pattern, max_dist=120, deadline=None):
     """fuzzy search pattern in string. Return (start,end,dist).
 
     Keyword arguments:
     max_dist -- character level edit distance allowed
+    deadline -- time.monotonic() after which to raise TimeoutError
 
     >>> fuzzy_search("hello world xxx", "word")
     (6, 11, 1)
     """
-
-    # write string into a temp [file]
-    fp = tempfile.NamedTemporaryFile(mode='w')
-    fp.write(string)
-    fp.flush()
     # pattern should not contain brackets
     pattern = re.sub(r'[()\[\]]', '', pattern)
-    # run agrep in shell
-    cmd = ['tre-agrep', '-E', str(max_dist), '-d',
-           'fjdsilfadsj', '--show-position',
-           # treat pattern as literal. This should increase
-           # performance
-           '--literal',
-           # only match whole word
-           '--word-regexp',
-           '--show-cost',
-           '--delete-cost=1',
-           '--insert-cost=1',
-           # disable direct substitute
-           '--substitute-cost=3',
-           pattern,
-           fp.name]
-    # print(' '.join(cmd))
-    completed = subprocess.run(cmd, stdout=subprocess.PIPE)
-    output = completed.stdout.decode('utf8')
-    # print(output)
-    # parse results
-    res = re.search('(\d+):(\d+)-(\d+)', output)
-    # print('temp name: ' + fp.name)
-    # fp.close()
-    if res:
-        d = int(res.group(1))
-        start = int(res.group(2))
-        end = int(res.group(3))
-        return start, end, d
-    else:
-        # print('warning: cannot find "' +
-        #       '(' + str(len(pattern)) + ') ' +
-        #       pattern.replace('\n', ' ') +
-        #       '"')
-        return None
+    return text_matcher(string).find(pattern, max_dist, deadline)
 
 
 # sort indexes (indexes should not overlap)
@@ -282,41 +248,21 @@ def extend_lists(ls):
 def treat_tag(string):
     """Remove html tags and return a tuple.
 
-    1. the clean string, and 2. the list of index of removed
-    content. [(start, length), (start, length)], where the start is
-    the index in the new clean string
-
-    """
-    removals = [(m.start(), m.end()) for m in re.finditer('<[^>]*>', string)]
-    removed = 0
-    res = []
-    for r in removals:
-        length = r[1] - r[0]
-        start = r[0] - removed
-        removed += length
-        res.append((start, length))
-    return (re.sub('<[^>]*>', '', string), res)
+    1. the clean string, and 2. the OffsetMap from the clean string back
+    to string
 
-
-def recover_tag(index, removed_indexes):
-    """Recover the indexes by considering the removed_indexes back.
+    >>> clean, offsets = treat_tag('a <b>bold</b> c')
+    >>> clean, offsets.original([2, 6]).tolist()
+    ('a bold c', [2, 9])
     """
-    def func(pos):
-        return pos + sum([r[1] for r in removed_indexes if r[0] < pos])
-    return func(index[0]), func(index[1])
+    return OffsetMap.from_pattern(string, '<[^>]*>')
 
 
 def treat_unicode(string):
-    unicode_indexes = [idx for idx, c in enumerate(string)
-                       if ord(c) > 127]
-    res = ''.join([c for c in string if ord(c) <= 127])
-    return res, unicode_indexes
-
-
-def recover_unicode(index, unicode_indexes):
-    def func(pos):
-        return pos + len([i for i in unicode_indexes if i < pos])
-    return func(index[0]), func(index[1])
+    """Remove non-ascii characters, return the clean string and its
+    OffsetMap back to string
+    """
+    return OffsetMap.from_pattern(string, r'[^\x00-\x7f]+')
 
 
 def append_lists(lsts):
@@ -434,9 +380,10 @@ def generate(publisher_html, extract_html, output_file):
     # collapse (white)space
     publisher_content = re.sub(r' +', ' ', publisher_content)
 
-    treated_content, removed_indexes = treat_tag(publisher_content)
+    treated_content, tag_offsets = treat_tag(publisher_content)
     # remove unicode
-    treated_content, unicode_indexes = treat_unicode(treated_content)
+    treated_content, unicode_offsets = treat_unicode(treated_content)
+    offsets = unicode_offsets.then(tag_offsets)
 
     print('searching ..')
 
@@ -449,11 +396,8 @@ def generate(publisher_html, extract_html, output_file):
     indexes = [fuzzy_search_multi(treated_content, hl) for hl in hls]
     # remove None
     indexes = [index[:-1] for index in indexes if index]
-    recovered_indexes = list(map(lambda x:
-                                 recover_tag(
-                                     recover_unicode(x, unicode_indexes),
-                                     removed_indexes),
-                                 indexes))
+    recovered_indexes = [(start, end) for start, end in
+                         offsets.original(indexes).reshape(-1, 2).tolist()]
     # into two groups, highlight or not
     hl_indexes = merge_sort_indexes(recovered_indexes)
 
@@ -525,12 +469,6 @@ if __name__ == '__main__':
 if __name__ == '__test__':
     doctest.testmod()
 
-    with timeout(seconds=3):
-        try:
-            time.sleep(4)
-        except TimeoutError:
-            print('timeout')
-
     publisher_html = './html_output/66.html'
     extract_html = '../test/html/66.html'
     
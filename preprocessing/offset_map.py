@@ -0,0 +1,88 @@
+# Map offsets in a cleaned string back to the string it was cleaned from
+#
+# hl_fulltext_align removes html tags, then non-ascii characters, from
+# the publisher text before aligning, and maps the aligned offsets back.
+import re
+import numpy as np
+
+
+class OffsetMap:
+    """Offsets of a cleaned string -> offsets in the original string
+
+    Stored as sorted breakpoints and the shift (original - cleaned) of
+    the offsets from each breakpoint on, so a lookup is a binary search.
+    Offsets can be a single int or an array of any shape.
+
+    Args:
+        starts: sorted cleaned offsets where the shift changes
+        shifts: len(starts) + 1 shifts, shifts[0] for the offsets before
+                starts[0], shifts[k] for the offsets from starts[k-1] on
+    """
+    def __init__(self, starts, shifts):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.shifts = np.asarray(shifts, dtype=np.int64)
+
+    @classmethod
+    def from_removals(cls, removals):
+        """Map of a string with the removals [(start, length)] taken out
+
+        start is the offset of a removal in the cleaned string. An offset
+        is shifted by the removals starting strictly before it, so the
+        offset of a removal maps to just before the removed text.
+
+        >>> m = OffsetMap.from_removals([(1, 3), (2, 3)])  # a<b>b<c>c -> abc
+        >>> [m.original(i) for i in range(4)]
+        [0, 1, 5, 9]
+        """
+        removals = sorted(removals)
+        starts = np.array([start + 1 for start, _ in removals], dtype=np.int64)
+        shifts = np.zeros(len(removals) + 1, dtype=np.int64)
+        np.cumsum([length for _, length in removals], out=shifts[1:])
+        return cls(starts, shifts)
+
+    @classmethod
+    def from_pattern(cls, string, pattern):
+        """Cleaned string and map of string with all the matches of a regex removed
+
+        >>> clean, m = OffsetMap.from_pattern('a<b>b<c>c', '<[^>]*>')
+        >>> clean, m.original([[1, 2], [0, 3]]).tolist()
+        ('abc', [[1, 5], [0, 9]])
+        """
+        removals = []
+        removed = 0
+        for match in re.finditer(pattern, string):
+            length = match.end() - match.start()
+            removals.append((match.start() - removed, length))
+            removed += length
+        return re.sub(pattern, '', string), cls.from_removals(removals)
+
+    def original(self, offsets):
+        """Offsets in the original string of the cleaned offsets"""
+        offsets = np.asarray(offsets, dtype=np.int64)
+        result = offsets + self.shifts[np.searchsorted(self.starts, offsets, 'right')]
+        return int(result) if result.ndim == 0 else result
+
+    def then(self, other):
+        """Map of cleaning with self after cleaning with other
+
+        self maps offsets of a string cleaned twice to the string cleaned
+        once, other from there to the original string.
+
+        >>> tags = OffsetMap.from_removals([(1, 3)])   # a<b>ébc -> aébc
+        >>> chars = OffsetMap.from_removals([(1, 1)])  # aébc -> abc
+        >>> both = chars.then(tags)
+        >>> [both.original(i) for i in range(4)], [tags.original(chars.original(i)) for i in range(4)]
+        ([0, 1, 6, 7], [0, 1, 6, 7])
+        """
+        # Segment k of self, [starts[k-1], starts[k]), maps to offsets up to last[k]
+        last = np.append(self.starts - 1 + self.shifts[:-1], np.iinfo(np.int64).max)
+        # The first offset of self mapping to each breakpoint of other or after
+        k = np.searchsorted(last, other.starts, 'left')
+        lows = np.insert(self.starts, 0, np.iinfo(np.int64).min)[k]
+        firsts = np.maximum(lows, other.starts - self.shifts[k])
+
+        starts = np.union1d(self.starts, firsts)
+        before = starts[0] - 1 if len(starts) > 0 else 0
+        points = np.insert(starts, 0, before)
+        shifts = other.original(self.original(points)) - points
+        return OffsetMap(starts, shifts)
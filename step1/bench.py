@@ -0,0 +1,248 @@
+"""Micro-benchmarks for step1
+
+    python bench.py tokens [--limit N]
+    python bench.py pipeline [--docs N] [--pages N] [--save results.json]
+                             [--baseline results.json] [--threshold 0.2]
+
+tokens: feature_engineering, old per-token regex path vs. TokenClassifier,
+        on the sentences of dataset_folder
+pipeline: every stage of step1 (doc2word, word2sentence, feature_per_line,
+        feature_finalize, SVM.train, SVM.predict, addPredHighlight) on
+        synthetic highlighted pdfs, with CoreNLP and SciBERT stubbed out.
+        Reports seconds, sentences/s and peak RSS per stage; with --baseline
+        it exits with 1 if a stage got slower by more than --threshold.
+        Use the same --docs/--pages/--seed as the baseline run.
+"""
+import os
+import re
+import sys
+import time
+import json
+import random
+import shutil
+import hashlib
+import platform
+import argparse
+import tempfile
+import resource
+import numpy as np
+import config as cfg
+import feature as pre
+
+def legacy_feature_engineering(Tokens, Units):
+    """feature_engineering as it was before TokenClassifier, for comparison
+    """
+    Collapse_dim= {"number":0, "unit":0, "A1-A1": 0, "UPPER": 0, "CamelCase": 0}
+    Remain_tokens=[]
+    for t in Tokens:
+        if re.match(r'[\d.-]+', t):
+            Collapse_dim["number"] += 1
+        elif t in Units:
+            Collapse_dim["unit"] += 1
+        elif re.fullmatch(r'(\w+-)+(\w+)', t):
+            Collapse_dim["A1-A1"] += 1
+        elif re.fullmatch(r'[A-Z]+\d*', t):
+            Collapse_dim["UPPER"] += 1
+        elif re.fullmatch(r'([A-Z][a-z]+){2,}', t):
+            Collapse_dim["CamelCase"] += 1
+        else:
+            Remain_tokens.append(t)
+
+    return Collapse_dim, Remain_tokens
+
+def load_dataset_texts(folder, limit=None):
+    texts = []
+    for file in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, file), 'r', encoding='utf-8') as f:
+            for Line in f:
+                if len(Line) > 5:
+                    texts.append(Line[1:].strip())
+                if limit is not None and len(texts) >= limit:
+                    return texts
+    return texts
+
+def timeit(func, *args, **kwargs):
+    st = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - st
+
+def bench_tokens(limit=None):
+    texts = load_dataset_texts(cfg.dataset_folder, limit)
+    # Whitespace tokens of the normalized text stand in for CoreNLP output
+    token_lists = [pre.manual_tune_pre(pre.strip_special(text)[0]).split() for text in texts]
+    units = open(cfg.unit_file, 'r').read().split()
+    num_tokens = sum(len(tokens) for tokens in token_lists)
+    print("{} sentences, {} tokens".format(len(token_lists), num_tokens))
+
+    legacy, t_legacy = timeit(lambda: [legacy_feature_engineering(tokens, units) for tokens in token_lists])
+    classifier = pre.TokenClassifier(units)
+    cold, t_cold = timeit(classifier.classify_corpus, token_lists)
+    # Second run: every token is already in the memo
+    warm, t_warm = timeit(classifier.classify_corpus, token_lists)
+    assert(legacy == cold == warm)
+
+    for name, t in [("legacy per token", t_legacy), ("TokenClassifier cold", t_cold), ("TokenClassifier warm", t_warm)]:
+        print("{:<22}{:8.3f}s {:12.0f} tokens/s {:6.1f}x".format(name, t, num_tokens / t, t_legacy / t))
+
+SYNTHETIC_WORDS = ["model", "data", "result", "method", "we", "the", "of", "a", "in", "is",
+                   "10", "mg", "kg", "SVM", "DeepLearning", "state-of-the-art", "et", "al.",
+                   "Fig.", "e.g.", "sig-", "nal", "shows.", "works.", "here?", "done!"]
+
+def make_pdf(pdf_file, pages, rng):
+    """Write a pdf of random text lines with some multi-line highlights
+    """
+    import fitz
+    pdf = fitz.open()
+    for _ in range(pages):
+        page = pdf.new_page()
+        lines = []
+        for y in range(60, 780, 14):
+            text = " ".join(rng.choice(SYNTHETIC_WORDS) for _ in range(rng.randint(4, 11)))
+            page.insert_text((50, y), text, fontsize=10)
+            lines.append((y, fitz.get_text_length(text, fontsize=10)))
+        for _ in range(rng.randint(2, 6)):
+            st = rng.randrange(len(lines) - 3)
+            quads = [fitz.Rect(50, y - 10, 50 + width, y + 3) for y, width in lines[st:st + rng.randint(1, 3)]]
+            page.add_highlight_annot(quads=quads)
+    pdf.save(pdf_file)
+    pdf.close()
+
+class StubLemmatizer:
+    """Stands in for lemmatizer.BatchLemmatizer: whitespace tokens, lower-cased
+    """
+    def lemma(self, texts):
+        return [[(word, word.lower()) for word in text.split()] for text in texts]
+
+class StubEmbeddingStore:
+    """Stands in for embed_store.EmbeddingStore: a fixed random vector per sentence
+    """
+    def embed(self, texts, model, tokenizer):
+        vectors = np.empty((len(texts), 768), dtype=np.float32)
+        for i, text in enumerate(texts):
+            seed = int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16)
+            vectors[i] = np.random.default_rng(seed).standard_normal(768)
+        return vectors
+
+def stub_processors():
+    return {'nlp': None, 'lemmatizer': StubLemmatizer(), 'lemma_cache': None,
+            'tokenizer': None, 'model': 'stub', 'store': StubEmbeddingStore()}
+
+def peak_rss_mb():
+    """Peak RSS in MB since the last reset_peak_rss (since start if not supported)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+def reset_peak_rss():
+    # Linux only: writing 5 to clear_refs resets VmHWM
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def stage(results, name, func, *args, **kwargs):
+    """Run func as stage name, record its seconds and peak RSS in results
+    """
+    reset_peak_rss()
+    result, t = timeit(func, *args, **kwargs)
+    results[name] = {'seconds': t, 'peak_rss_mb': peak_rss_mb()}
+    return result
+
+def bench_pipeline(docs=8, pages=6, seed=0):
+    import highlights as hl
+    from model import SVM
+    rng = random.Random(seed)
+    folder = tempfile.mkdtemp(prefix='bench_')
+    try:
+        pdf_files = []
+        for d in range(docs):
+            pdf_files.append(os.path.join(folder, "doc{}.pdf".format(d)))
+            make_pdf(pdf_files[-1], pages, rng)
+        cfg.pdf_cache_folder = os.path.join(folder, 'pdf_cache')
+
+        results = {}
+        words = stage(results, 'doc2word', lambda: [hl.doc2word(f) for f in pdf_files])
+        stage(results, 'doc2word (cached)', lambda: [hl.doc2word(f) for f in pdf_files])
+        sents = stage(results, 'word2sentence', lambda: [hl.word2sentence(doc) for doc in words])
+        texts = [text for doc in sents for text in doc.sentences()]
+        labels = np.concatenate([doc.sentence_labels() for doc in sents]).tolist()
+
+        model = SVM()
+        processor = stub_processors()
+        features = stage(results, 'feature_per_line', pre.raw_features, texts, None,
+                         model.meta['stopwords'], model.meta['units'], processor['lemmatizer'],
+                         model=processor['model'], store=processor['store'])
+        v, DF = pre.count_voc_df([feature[1] for feature in features])
+        model.meta['IDF'] = pre.idf_from_df(DF, len(features))
+        X = stage(results, 'feature_finalize', pre.feature_finalize, features, model.meta['IDF'])
+        stage(results, 'SVM.train', model.fit_features, X, labels)
+        model.processor = processor
+        predicted = stage(results, 'SVM.predict', model.predict, texts)
+
+        def write_all():
+            st = 0
+            for pdf_file, doc in zip(pdf_files, sents):
+                sent_ids = np.flatnonzero(predicted[st:st+doc.n_sents] == 1)
+                st += doc.n_sents
+                hl.addPredHighlight(pdf_file, pdf_file[:-4] + '.out.pdf', doc, sent_ids, False)
+        stage(results, 'addPredHighlight', write_all)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    print("{} pdfs, {} pages, {} words, {} sentences, {} highlighted".format(
+        docs, docs * pages, sum(doc.n_words for doc in words), len(texts), sum(labels)))
+    for name, result in results.items():
+        result['sentences_per_sec'] = len(texts) / max(result['seconds'], 1e-9)
+        print("{:<20}{:8.3f}s {:12.0f} sentences/s {:8.1f} MB peak RSS".format(
+            name, result['seconds'], result['sentences_per_sec'], result['peak_rss_mb']))
+    return results
+
+def compare(results, baseline, threshold, min_seconds=0.05):
+    """Names of the stages more than threshold (e.g. 0.2 = 20%) slower than baseline
+
+    Stages that took less than min_seconds in the baseline are too noisy to compare.
+    """
+    slower = []
+    for name, result in results.items():
+        if name not in baseline or baseline[name]['seconds'] < min_seconds:
+            continue
+        ratio = result['seconds'] / max(baseline[name]['seconds'], 1e-9)
+        print("{:<20}{:8.3f}s vs {:8.3f}s {:6.2f}x".format(name, result['seconds'], baseline[name]['seconds'], ratio))
+        if ratio > 1 + threshold:
+            slower.append(name)
+    return slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', choices=['tokens', 'pipeline'])
+    parser.add_argument('--limit', type=int, default=None, help='max sentences to use')
+    parser.add_argument('--docs', type=int, default=8, help='synthetic pdfs for pipeline')
+    parser.add_argument('--pages', type=int, default=6, help='pages per synthetic pdf')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', default=None, help='write the pipeline results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='JSON file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against baseline')
+    parser.add_argument('--min-seconds', type=float, default=0.05, help='do not compare stages faster than this')
+    args = parser.parse_args()
+    if args.bench == 'tokens':
+        bench_tokens(args.limit)
+    elif args.bench == 'pipeline':
+        stages = bench_pipeline(args.docs, args.pages, args.seed)
+        if args.save is not None:
+            with open(args.save, 'w', encoding='utf-8') as f:
+                json.dump({'docs': args.docs, 'pages': args.pages, 'seed': args.seed,
+                           'python': platform.python_version(), 'stages': stages}, f, indent=2)
+        if args.baseline is not None:
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+            slower = compare(stages, baseline['stages'], args.threshold, args.min_seconds)
+            if len(slower) > 0:
+                print("Regression (> {:.0%} slower):".format(args.threshold), ", ".join(slower))
+                sys.exit(1)
@@ -1,3 +1,5 @@
+import os
+
 stanfordcorenlp_jar_location = '/home/gluo/stanford-corenlp-full-2018-02-27/'
 stopword_path = 'sci_stopwords.txt'
 unit_file = 'units.txt'
@@ -8,14 +10,32 @@ hl_pdf_folder = "./highlighted_pdfs/"
 dataset_folder = "./dataset/"
 input_folder = pdf_download_path
 output_folder = "./output/"
+loo_cache_folder = "./loo_cache/"   # Per-document features for leave_one_out.py
+pdf_cache_folder = "./pdf_cache/"   # Extracted words/annotations of each pdf, see pdfcache.py
+build_manifest_file = "./build_manifest.json"   # Inputs of each highlighted pdf and tsv, see manifest.py
 
 train_tsv_file = 'all.tsv'
-preprocessed_file = 'preprocessed.pickle'
+preprocessed_folder = './preprocessed/'   # See matrix_io.save_dataset
 model_file = 'model.pickle'
 
-SCIBERT_DB = 'embed.hdf5'
+SCIBERT_DB = 'embed_store.hdf5'   # sha1-keyed embedding store, see embed_store.py
+SCIBERT_BATCH_SIZE = 32            # Sentences per SciBERT forward pass
+CORENLP_BATCH_SIZE = 64            # Sentences per CoreNLP annotate request
+CORENLP_INFLIGHT = 4               # Concurrent CoreNLP requests
+CORENLP_VERSION = os.path.basename(os.path.normpath(stanfordcorenlp_jar_location))
+LEMMA_CACHE_DB = 'lemma_cache.sqlite'   # Lemmas keyed by normalized sentence, see lemmatizer.LemmaCache
+LEMMA_CACHE_MEMORY = 100000        # Max lemma cache entries kept in memory
+FEATURE_WORKERS = 1                # Processes for build_features, 1 = serial
+LOO_WORKERS = 4                    # Folds trained in parallel by leave_one_out.py
+PREDICT_BATCH_SIZE = 4096          # Sentences per clf.predict call in main.py
+PREDICT_FILES_PER_BATCH = 8        # PDFs whose sentences are predicted together in main.py
+HIGHLIGHT_WORKERS = 4              # Processes for the per-pdf stages of highlights.py and main.py, 1 = serial
+PDF_SAVE_GARBAGE = 3               # garbage option of fitz Document.save for highlighted pdfs (0-4)
+PDF_SAVE_DEFLATE = True            # Compress the streams of highlighted pdfs
 
 GENERATE_HL_PDF = True     # Generate highlighted pdf files based on mendeley annotation
 GENERATE_HL_TSV = True     # Generate highlight dataset from pdfs
+INCREMENTAL_BUILD = True   # Skip highlighted pdfs and tsvs whose inputs did not change
 NEGATIVE_RATIO = 3         # Nagative sampling ratio
+PREPROCESS_CHUNK_SIZE = 10000   # Lines per chunk when streaming the training TSV
 USE_SCIBERT = True         # SciBert sentence embedding
\ No newline at end of file
@@ -0,0 +1,88 @@
+import numpy as np
+
+class Document:
+    """Words and sentences of a pdf, stored column-wise
+
+    Word i is ``text[word_start[i]:word_end[i]]`` in one string of all the
+    words joined by ' ', so the text of words [st, ed) is the slice
+    ``text[word_start[st]:word_end[ed-1]]``. Per word there are typed
+    arrays for the page, the (document-wide) block and the label. A word
+    has one box per line it is printed on (two for a word hyphenated
+    across lines): its boxes are ``boxes[box_ptr[i]:box_ptr[i+1]]`` with
+    the line numbers in ``box_line``.
+
+    Sentences are word ranges [sent_start[j], sent_end[j]) in reading
+    order, set by ``set_sentences``.
+
+    Args:
+        words: list of word texts
+        pages, blocks, labels: one value per word
+        box_ptr: (n_words + 1) offsets into boxes/box_lines
+        boxes: (n_boxes, 4) x0, y0, x1, y1
+        box_lines: line number of each box
+        n_pages: number of pages, pages without words included
+    """
+    def __init__(self, words, pages, blocks, labels, box_ptr, boxes, box_lines, n_pages):
+        self.text = " ".join(words)
+        lengths = np.array([len(word) for word in words], dtype=np.int64)
+        self.word_start = np.zeros(len(words), dtype=np.int64)
+        if len(words) > 0:
+            self.word_start[1:] = np.cumsum(lengths + 1)[:-1]
+        self.word_end = self.word_start + lengths
+
+        self.word_page = np.asarray(pages, dtype=np.int32)
+        self.word_block = np.asarray(blocks, dtype=np.int32)
+        self.word_label = np.asarray(labels)
+        self.box_ptr = np.asarray(box_ptr, dtype=np.int64)
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.box_line = np.asarray(box_lines, dtype=np.int32)
+        self.n_pages = n_pages
+        self.set_sentences(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    def set_sentences(self, starts, ends):
+        self.sent_start = np.asarray(starts, dtype=np.int64)
+        self.sent_end = np.asarray(ends, dtype=np.int64)
+
+    @property
+    def n_words(self):
+        return len(self.word_start)
+
+    @property
+    def n_sents(self):
+        return len(self.sent_start)
+
+    def word(self, i):
+        return self.text[self.word_start[i]:self.word_end[i]]
+
+    def words(self, st=0, ed=None):
+        ed = self.n_words if ed is None else ed
+        return [self.text[s:e] for s, e in zip(self.word_start[st:ed].tolist(), self.word_end[st:ed].tolist())]
+
+    def sentence(self, j):
+        """Text of sentence j, its words joined by ' '"""
+        return self.text[self.word_start[self.sent_start[j]]:self.word_end[self.sent_end[j]-1]]
+
+    def sentences(self):
+        starts = self.word_start[self.sent_start].tolist()
+        ends = self.word_end[self.sent_end - 1].tolist()
+        return [self.text[s:e] for s, e in zip(starts, ends)]
+
+    def sentence_pages(self):
+        return self.word_page[self.sent_start]
+
+    def sentence_labels(self):
+        """Per sentence, whether any of its words is labeled (nonzero)"""
+        if self.n_sents == 0:
+            return np.zeros(0, dtype=np.int8)
+        # Sentences are consecutive and cover every word, so reduceat on the starts works
+        return np.logical_or.reduceat(self.word_label != 0, self.sent_start).astype(np.int8)
+
+    def page_sentences(self, p):
+        """Range [st, ed) of the sentences on page p"""
+        pages = self.sentence_pages()
+        return np.searchsorted(pages, p, 'left'), np.searchsorted(pages, p, 'right')
+
+    def sentence_boxes(self, j):
+        """Boxes (n, 4) and their line numbers of the words of sentence j"""
+        st, ed = self.box_ptr[self.sent_start[j]], self.box_ptr[self.sent_end[j]]
+        return self.boxes[st:ed], self.box_line[st:ed]
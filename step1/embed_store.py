@@ -0,0 +1,115 @@
+import hashlib
+import traceback
+import numpy as np
+import h5py
+
+EMBED_DIM = 768
+
+def sentence_key(text):
+    """Stable content hash of a sentence, used as its key in the store
+
+    >>> sentence_key("hello")
+    'aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d'
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class EmbeddingStore:
+    """SciBERT sentence embeddings cached in one HDF5 file
+
+    All embeddings are kept in a contiguous float32 matrix ``vectors`` (N x 768).
+    Row i belongs to the sentence whose sha1 is ``keys[i]``; the key -> row index
+    is loaded once when the store is opened. The file handle stays open until
+    ``close()`` so a whole run shares it.
+
+    Sentences not in the store are embedded in padded batches of ``batch_size``
+    and appended with a single resize per batch.
+
+    ``hits`` and ``misses`` count the sentences answered from the store and the
+    sentences that had to go through the model.
+    """
+    def __init__(self, path, batch_size=32, max_length=512):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.hits = 0
+        self.misses = 0
+
+        self.f = h5py.File(path, 'a')
+        if 'vectors' not in self.f:
+            self.f.create_dataset('vectors', shape=(0, EMBED_DIM), maxshape=(None, EMBED_DIM),
+                                  dtype='float32', chunks=(256, EMBED_DIM))
+            self.f.create_dataset('keys', shape=(0,), maxshape=(None,),
+                                  dtype='S40', chunks=(4096,))
+        self.index = {key.decode('ascii'): i for i, key in enumerate(self.f['keys'][:])}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def embed(self, texts, model, tokenizer):
+        """Return the embeddings of texts as a float32 matrix (len(texts) x 768)
+
+        Sentences the model fails on get a zero vector, which is not stored.
+        """
+        keys = [sentence_key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self.index and key not in missing:
+                missing[key] = text
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+
+        failed = set()
+        todo = list(missing.items())
+        for st in range(0, len(todo), self.batch_size):
+            batch = todo[st:st+self.batch_size]
+            try:
+                vectors = self._forward([text for _, text in batch], model, tokenizer)
+            except Exception:
+                print(traceback.format_exc())
+                failed.update(key for key, _ in batch)
+                continue
+            self._append([key for key, _ in batch], vectors)
+
+        result = np.zeros((len(texts), EMBED_DIM), dtype=np.float32)
+        found = [i for i, key in enumerate(keys) if key not in failed]
+        if len(found) > 0:
+            rows = np.array([self.index[keys[i]] for i in found])
+            # h5py wants increasing, unique coordinates
+            uniq, inverse = np.unique(rows, return_inverse=True)
+            result[found] = self.f['vectors'][uniq][inverse]
+        return result
+
+    def _forward(self, texts, model, tokenizer):
+        inputs = tokenizer(texts, padding=True, truncation=True,
+                           max_length=self.max_length, return_tensors="pt")
+        outputs = model(**inputs)
+        return outputs.pooler_output.detach().numpy().astype(np.float32)
+
+    def _append(self, keys, vectors):
+        n = len(self.index)
+        size = n + len(keys)
+        self.f['vectors'].resize(size, axis=0)
+        self.f['vectors'][n:size] = vectors
+        self.f['keys'].resize(size, axis=0)
+        self.f['keys'][n:size] = np.array(keys, dtype='S40')
+        for i, key in enumerate(keys):
+            self.index[key] = n + i
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
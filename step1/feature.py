@@ -2,15 +2,17 @@
 
 
 import re, collections, math
+import multiprocessing
 from numpy.core.fromnumeric import trace
 from six import python_2_unicode_compatible
 import stanfordcorenlp
 # from preprocessing.gen_data import calculate_special_feature_vector
 import csv
 import numpy as np
-import h5py
+from scipy import sparse
 import config as cfg
-import traceback
+from embed_store import EmbeddingStore
+from lemmatizer import BatchLemmatizer
 from tqdm import tqdm
 
 def lemma_func(nlp_handler, sentence):
@@ -30,62 +32,125 @@ def build_features(texts, nlp, stopwords, units, **kwargs):
     units = open(unit_file, 'r').read().split()
     """
 
-    Features = []
-    
-    for i in tqdm(range(len(texts))):
-        Features.append(feature_per_line(texts[i], nlp, stopwords, units, **kwargs)) 
+    if cfg.FEATURE_WORKERS > 1:
+        Features, v, DF = parallel_raw_features(texts, nlp, stopwords, units, cfg.FEATURE_WORKERS,
+                                                progress=True, **kwargs)
+        v, DF = drop_low_freq(v, DF)
+    else:
+        Features = raw_features(texts, nlp, stopwords, units, progress=True, **kwargs)
+        v, DF = voc_df_from_unigram_counts([Feature[1] for Feature in Features])
 
     # nlp.close()
 
-    v, DF = voc_df_from_unigram_counts([Feature[1] for Feature in Features])
-
     # finalize features using length and total vocablary, e.g., tf-idf
-    DF = dict(DF) # from collection.defaultdict to regular dict
-    Doc_count = len(Features)
-    # from direct document number to logarithmic IDF
-    IDF = {term:math.log(Doc_count/df) for term, df in DF.items() }
+    IDF = idf_from_df(DF, len(Features))
     Features = feature_finalize(Features, IDF) 
 
     return Features, IDF
 
+def idf_from_df(DF, Doc_count):
+    """From direct document number to logarithmic IDF, a regular dict in DF order
+    """
+    return {term:math.log(Doc_count/df) for term, df in DF.items() }
+
 def convert_features(texts, nlp, stopwords, units, IDF, **kwargs):
-    Features = []
-    for text in texts:
-        Features.append(feature_per_line(text, nlp, stopwords, units, **kwargs))
+    Features = raw_features(texts, nlp, stopwords, units, **kwargs)
     Features = feature_finalize(Features, IDF)
     return Features
 
-def feature_per_line(Text, nlp_handler, stopwords, units, model, tokenizer, **kwargs):
-    """Turn a string/sentence into a feature vector
+def raw_features(texts, nlp, stopwords, units, lemmatizer=None, lemma_cache=None, progress=False, **kwargs):
+    """feature_per_line on every text, with lemmatization and embedding done in batches
+    """
+    if not isinstance(units, TokenClassifier):
+        units = TokenClassifier(units)
+    embeddings = sentence_embeddings(texts, **kwargs)
+    tokens = text_normalize_batch(nlp, [strip_special(text)[0] for text in texts], lemmatizer, lemma_cache)
+
+    Features = []
+    for i in tqdm(range(len(texts)), disable=not progress):
+        Features.append(feature_per_line(texts[i], nlp, stopwords, units, embeddings[i], tokens[i]))
+    return Features
+
+def parallel_raw_features(texts, nlp, stopwords, units, workers, lemma_cache=None, progress=False, **kwargs):
+    """raw_features with the sentences sharded over a pool of worker processes
+
+    Each worker has its own CoreNLP client to the server of nlp and returns
+    its features together with the unigram and document frequency counts of
+    its shard. The lemma cache and the embeddings stay in this process.
+
+    Returns:
+        Features, same as raw_features
+        v, DF: merged counts of all shards, before drop_low_freq
+    """
+    Normalized = [manual_tune_pre(strip_special(text)[0]) for text in texts]
+    Lemmas = [None] * len(texts)
+    if lemma_cache is not None:
+        Lemmas = lemma_cache.get_many(Normalized)
+    # Only resolve (and start) the server if some sentence needs it
+    url = nlp.url if any(lemmas is None for lemmas in Lemmas) else None
+
+    size = math.ceil(len(texts) / (workers * 4)) if len(texts) > 0 else 1
+    shards = [(texts[st:st+size], Lemmas[st:st+size]) for st in range(0, len(texts), size)]
+
+    Features, parts = [], []
+    with multiprocessing.Pool(workers, _feature_worker_init, (url, stopwords, units)) as pool:
+        for shard_features, new_lemmas, v, DF in tqdm(pool.imap(_feature_worker, shards),
+                                                      total=len(shards), disable=not progress):
+            Features.extend(shard_features)
+            parts.append((v, DF))
+            if lemma_cache is not None and len(new_lemmas) > 0:
+                lemma_cache.put_many(list(new_lemmas), list(new_lemmas.values()))
+
+    embeddings = sentence_embeddings(texts, **kwargs)
+    Features = [Feature[:4] + (embedding,) for Feature, embedding in zip(Features, embeddings)]
+    v, DF = merge_voc_df(parts)
+    return Features, v, DF
+
+_worker = {}
+
+def _feature_worker_init(url, stopwords, units):
+    _worker['lemmatizer'] = BatchLemmatizer(url, cfg.CORENLP_BATCH_SIZE, inflight=cfg.CORENLP_INFLIGHT)
+    _worker['stopwords'] = stopwords
+    _worker['units'] = units if isinstance(units, TokenClassifier) else TokenClassifier(units)
+
+def _feature_worker(shard):
+    texts, Lemmas = shard
+    Normalized = [manual_tune_pre(strip_special(text)[0]) for text in texts]
+    todo = [i for i in range(len(texts)) if Lemmas[i] is None]
+    results = _worker['lemmatizer'].lemma([Normalized[i] for i in todo])
+    Lemmas = list(Lemmas)
+    new_lemmas = {}
+    for i, result in zip(todo, results):
+        Lemmas[i] = [lemma for _, lemma in result]
+        new_lemmas[Normalized[i]] = Lemmas[i]
+
+    Features = [feature_per_line(text, None, _worker['stopwords'], _worker['units'], None, lemmas_to_tokens(lemmas))
+                for text, lemmas in zip(texts, Lemmas)]
+    v, DF = count_voc_df([Feature[1] for Feature in Features])
+    return Features, new_lemmas, v, DF
+
+def sentence_embeddings(texts, model=None, tokenizer=None, store=None, **kwargs):
+    """SciBERT embedding of every text, looked up in/added to the embedding store
+
+    Returns a list of 1-D arrays, or a list of None when SciBERT is not used.
     """
-    # Sentence Embedding Feature
-    embedding = np.zeros((1, 768), dtype=float)
-    try:
-        with h5py.File(cfg.SCIBERT_DB, 'a') as f:
-            key = Text.replace('/', '\\').encode('utf-8')
-            if key in f.keys():
-                embedding = f[key][:]
-            else:
-                # Can't deal with excetionally long sentences
-                inputs = tokenizer(Text, return_tensors="pt")
-                # Truncate at 512
-                for item in inputs:
-                    inputs[item] = inputs[item][:, :512]
-                outputs = model(**inputs)
-                embedding = outputs.pooler_output.detach().numpy()
-                f.create_dataset(key, data=embedding)
-    except Exception as e:
-        if not model is None:
-            print(Text)
-            print(traceback.print_exc())
-        
-    embedding = embedding.flatten()
     if model is None:
-        embedding = None
+        return [None] * len(texts)
+    if store is None:
+        with EmbeddingStore(cfg.SCIBERT_DB, cfg.SCIBERT_BATCH_SIZE) as store:
+            return list(store.embed(texts, model, tokenizer))
+    return list(store.embed(texts, model, tokenizer))
+
+def feature_per_line(Text, nlp_handler, stopwords, units, embedding=None, tokens=None, **kwargs):
+    """Turn a string/sentence into a feature vector
 
+    embedding: sentence embedding from sentence_embeddings, None to skip
+    tokens: text_normalize result of the text if already known
+    """
     Plain, tag_features = strip_special(Text) # <i>, <sup>, <sub> in a line 
     # print(Plain)
-    tokens = text_normalize(nlp_handler, Plain)
+    if tokens is None:
+        tokens = text_normalize(nlp_handler, Plain)
     tokens = remove_stopwords(tokens, stopwords)
 
     manual_features, tokens = feature_engineering(tokens, units) # collapse numbers and units 
@@ -104,28 +169,55 @@ def feature_finalize(Features, IDF):
                   2nd is unigram counts, collections.Couner
                   3rd is length of the text 
                   4th is manual features, dict 
+                  5th is the sentence embedding or None
 
         IDF: inverse document frequency
-    """
 
-    New_features = [] 
-
-    for tag_feature, unigram_counts, length, manual_feature, embedding in Features:
-        TFIDF = [idf * unigram_counts[term] for term, idf in IDF.items()]
-        feature_per_line = TFIDF + \
-                           list(manual_feature.values()) + \
-                           list(tag_feature.values())
-
-        # normalize feature vector by sentence/doc length
-        if length == 0:
-            # FIXME why zero
-            length = 1
-        length = 1 # Why normalize by length
-        feature_per_line = np.array([x/length for x in feature_per_line], dtype=float)
-        if not embedding is None:
-            feature_per_line = np.concatenate([feature_per_line, embedding])
-        New_features.append(feature_per_line)
-    return New_features
+    Returns:
+        scipy.sparse.csr_matrix, one row per line. Columns are the TF-IDF of
+        every term of IDF (in IDF order, see term_columns), then the manual
+        features, the tag features and the embedding if there is one.
+    """
+    columns, idf = term_columns(IDF)
+    if len(Features) == 0:
+        return sparse.csr_matrix((0, len(columns)))
+
+    rows, cols, counts = [], [], []
+    for i, (_, unigram_counts, _, _, _) in enumerate(Features):
+        for term, count in unigram_counts.items():
+            col = columns.get(term)
+            if col is not None:
+                rows.append(i)
+                cols.append(col)
+                counts.append(count)
+    cols = np.array(cols, dtype=np.int64)
+    TFIDF = sparse.csr_matrix((np.array(counts, dtype=float) * idf[cols], (rows, cols)),
+                              shape=(len(Features), len(columns)))
+
+    # No normalization by sentence/doc length, it used to be fixed at 1
+    Dense = np.array([list(manual_feature.values()) + list(tag_feature.values())
+                      for tag_feature, _, _, manual_feature, _ in Features], dtype=float)
+    blocks = [TFIDF, sparse.csr_matrix(Dense)]
+
+    embeddings = [Feature[4] for Feature in Features]
+    if not embeddings[0] is None:
+        blocks.append(sparse.csr_matrix(np.vstack(embeddings)))
+    return sparse.hstack(blocks, format='csr')
+
+_term_columns = (None, None, None)
+
+def term_columns(IDF):
+    """Fixed term -> column index of the TF-IDF block and the IDF values as an array
+
+    The result is kept for the last IDF seen, since prediction finalizes many
+    small batches against the same IDF.
+    """
+    global _term_columns
+    if _term_columns[0] is not IDF:
+        columns = {term: i for i, term in enumerate(IDF)}
+        idf = np.fromiter(IDF.values(), dtype=float, count=len(IDF))
+        _term_columns = (IDF, columns, idf)
+    return _term_columns[1], _term_columns[2]
  
 def voc_df_from_unigram_counts(Dicts, low_freq_cutoff=5):
     """Get the frequencies of words and raw document frequencies in all documents from a list of word freq dict/Counters
@@ -145,17 +237,40 @@ def voc_df_from_unigram_counts(Dicts, low_freq_cutoff=5):
         (Counter({'car': 2, 'mouse': 6, 'wine': 4}),
          defaultdict(int, {'car': 1, 'mouse': 2, 'wine': 1}))
 
+    """
+    v, DF = count_voc_df(Dicts)
+    return drop_low_freq(v, DF, low_freq_cutoff)
+
+def count_voc_df(Dicts):
+    """Step 1 of voc_df_from_unigram_counts: all words, their freqs and document freqs
     """
     v = collections.Counter()
     DF = collections.defaultdict(int)  # the size of set {d\in D : t \in d}
 
-    # 1. Get all words and their freqs. 
     for Dict in Dicts: 
-           v += Dict # append and add up the term frequencies
+           v.update(Dict) # append and add up the term frequencies
            for t in Dict:
                DF[t] += 1
 
-    # 2. Drop words of very low freqs in all docs 
+    return v, DF
+
+def merge_voc_df(parts):
+    """Merge (v, DF) counts of consecutive shards of the documents
+
+    Terms keep the order of their first appearance, same as counting all
+    documents at once.
+    """
+    v = collections.Counter()
+    DF = collections.defaultdict(int)
+    for part_v, part_DF in parts:
+        v.update(part_v)
+        for t, df in part_DF.items():
+            DF[t] += df
+    return v, DF
+
+def drop_low_freq(v, DF, low_freq_cutoff=5):
+    """Step 2 of voc_df_from_unigram_counts: drop words of very low freqs in all docs
+    """
     for t in list(v):
         if v[t] < low_freq_cutoff: 
             print (t)
@@ -176,27 +291,80 @@ def feature_engineering(Tokens, Units):
     >>> feature_engineering(["plasmids", "p416-Cyc-CAD", "and", "p416-Tef-CAD"], [])
     
     """
-    Collapse_dim= {"number":0, "unit":0, "A1-A1": 0, "UPPER": 0, "CamelCase": 0}
-    Remain_tokens=[]
-    # FIXME do we remove all these tokens?
-    for t in Tokens:
-        if re.match(r'[\d.-]+', t):
-            Collapse_dim["number"] += 1
-        elif t in Units:
-            Collapse_dim["unit"] += 1
-        elif re.fullmatch('(\w+-)+(\w+)', t):
-            # \w+\d+-\w+\d+-... like A1-A1, or ab1-cd23-gf76
-            Collapse_dim["A1-A1"] += 1
-        elif re.fullmatch('[A-Z]+\d*', t):
-            # frequencies of all upper case words
-            Collapse_dim["UPPER"] += 1
-        elif re.fullmatch('([A-Z][a-z]+){2,}', t):
-            # camel style, like aNb
-            Collapse_dim["CamelCase"] += 1
+    classifier = Units if isinstance(Units, TokenClassifier) else TokenClassifier(Units)
+    return classifier(Tokens)
+
+class TokenClassifier:
+    """Precompiled, single pass version of the token rules of feature_engineering
+
+    In order, a token is a
+        number: starts like a number, e.g., 3.0 or -5-5
+        unit: in the unit set
+        A1-A1: words joined by dashes, like A1-A1, or ab1-cd23-gf76
+        UPPER: all upper case word, maybe followed by digits
+        CamelCase: camel style, like CamelCaseWord
+    or is kept as is (None). The last three are one precompiled alternation.
+
+    Every distinct token is classified once and remembered, so a corpus is
+    classified in bulk for the cost of its vocabulary.
+
+    Args:
+        units: iterable of str, e.g., the words in units.txt
+    """
+    NUMBER = re.compile(r'[\d.-]+')
+    SHAPE = re.compile(r'(?P<a1>(?:\w+-)+\w+)|(?P<upper>[A-Z]+\d*)|(?P<camel>(?:[A-Z][a-z]+){2,})')
+    SHAPE_NAMES = {'a1': 'A1-A1', 'upper': 'UPPER', 'camel': 'CamelCase'}
+
+    def __init__(self, units):
+        self.units = frozenset(units)
+        self.memo = {}
+
+    def __getstate__(self):
+        # The memo is rebuilt on use, don't pickle it with the model
+        return {'units': self.units, 'memo': {}}
+
+    def __contains__(self, token):
+        return token in self.units
+
+    def classify(self, t):
+        """Collapse dimension of token t, or None if the token is kept
+        """
+        try:
+            return self.memo[t]
+        except KeyError:
+            pass
+        if self.NUMBER.match(t):
+            category = "number"
+        elif t in self.units:
+            category = "unit"
         else:
-            Remain_tokens.append(t)
+            m = self.SHAPE.fullmatch(t)
+            category = self.SHAPE_NAMES[m.lastgroup] if m else None
+        self.memo[t] = category
+        return category
+
+    def __call__(self, Tokens):
+        """Same as feature_engineering(Tokens, units)
+        """
+        Collapse_dim= {"number":0, "unit":0, "A1-A1": 0, "UPPER": 0, "CamelCase": 0}
+        Remain_tokens=[]
+        memo = self.memo
+        # FIXME do we remove all these tokens?
+        for t in Tokens:
+            category = memo[t] if t in memo else self.classify(t)
+            if category is None:
+                Remain_tokens.append(t)
+            else:
+                Collapse_dim[category] += 1
+        return Collapse_dim, Remain_tokens
+
+    def classify_corpus(self, Token_lists):
+        """feature_engineering on every token list of a corpus
 
-    return Collapse_dim, Remain_tokens
+        Only the first occurrence of each distinct token runs the rules, every
+        other one is a dictionary lookup.
+        """
+        return [self(Tokens) for Tokens in Token_lists]
 
 def load_stopwords(Path):
     stopwords = set(open(Path, 'r').read().split())
@@ -253,13 +421,56 @@ def text_normalize(nlp_handler, Text):
     Return type:
         tuple of str, each element is a token
     """
-    punctuations =set("`'?")
     Text = manual_tune_pre(Text)
     # lemmatization_result = nlp_handler.lemma(Text) # tokenization and lemmatization 
     lemmatization_result = lemma_func(nlp_handler, Text)
     # print(lemmatization_result)
-    _, Tokens = zip(*lemmatization_result)
-    Tokens = manual_tune_post(Tokens)
+    return lemmas_to_tokens([lemma for _, lemma in lemmatization_result])
+
+def text_normalize_batch(nlp_handler, Texts, lemmatizer=None, lemma_cache=None):
+    """text_normalize on a list of texts, lemmatized in batches
+
+    Only texts missing from lemma_cache are sent to CoreNLP, so nlp_handler
+    is not touched at all when every text is cached.
+
+    Args:
+        nlp_handler: an instance of stanfordcorenlp type
+        lemmatizer: lemmatizer.BatchLemmatizer, a temporary one is used if None
+        lemma_cache: lemmatizer.LemmaCache or None
+
+    Return type:
+        list of token lists, one per text
+    """
+    Texts = [manual_tune_pre(Text) for Text in Texts]
+    Lemmas = [None] * len(Texts)
+    if lemma_cache is not None:
+        Lemmas = lemma_cache.get_many(Texts)
+
+    todo = collections.defaultdict(list) # text -> positions, each distinct text is sent once
+    for i in range(len(Texts)):
+        if Lemmas[i] is None:
+            todo[Texts[i]].append(i)
+    if len(todo) > 0:
+        todo_texts = list(todo)
+        if lemmatizer is None:
+            with BatchLemmatizer(nlp_handler, cfg.CORENLP_BATCH_SIZE, inflight=cfg.CORENLP_INFLIGHT) as lemmatizer:
+                results = lemmatizer.lemma(todo_texts)
+        else:
+            results = lemmatizer.lemma(todo_texts)
+        results = [[lemma for _, lemma in result] for result in results]
+        if lemma_cache is not None:
+            lemma_cache.put_many(todo_texts, results)
+        for text, result in zip(todo_texts, results):
+            for i in todo[text]:
+                Lemmas[i] = result
+
+    return [lemmas_to_tokens(lemmas) for lemmas in Lemmas]
+
+def lemmas_to_tokens(Lemmas):
+    """Tokens of text_normalize from the CoreNLP lemmas of a sentence
+    """
+    punctuations =set("`'?")
+    Tokens = manual_tune_post(Lemmas)
 
     Tokens = [x for x in Tokens if x not in punctuations]
 
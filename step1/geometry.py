@@ -0,0 +1,169 @@
+import numpy as np
+
+# Page boxes are (N, 4) float arrays of x0, y0, x1, y1 rows, i.e. what
+# fitz.Rect and page.get_text('words')[:4] hold, one box per row.
+
+def as_boxes(rects):
+    """Stack rects (fitz.Rect, tuples or lists of 4 numbers) into an (N, 4) array
+
+    >>> as_boxes([(0, 0, 2, 1), [1, 1, 3, 3]]).tolist()
+    [[0.0, 0.0, 2.0, 1.0], [1.0, 1.0, 3.0, 3.0]]
+    >>> as_boxes([]).shape
+    (0, 4)
+    """
+    if len(rects) == 0:
+        return np.zeros((0, 4), dtype=np.float64)
+    return np.array([tuple(rect)[:4] for rect in rects], dtype=np.float64).reshape(-1, 4)
+
+def box_area(boxes):
+    """Area of every box, like fitz.Rect.getArea
+
+    >>> box_area(as_boxes([(0, 0, 2, 1), (1, 1, 3, 4)])).tolist()
+    [2.0, 6.0]
+    """
+    return np.abs(boxes[:, 2] - boxes[:, 0]) * np.abs(boxes[:, 3] - boxes[:, 1])
+
+def intersection_area(boxes, others):
+    """(N, M) areas of the intersections of every box with every other box
+
+    >>> intersection_area(as_boxes([(0, 0, 2, 2)]), as_boxes([(1, 1, 3, 3), (5, 5, 6, 6)])).tolist()
+    [[1.0, 0.0]]
+    """
+    w = np.minimum(boxes[:, None, 2], others[None, :, 2]) - np.maximum(boxes[:, None, 0], others[None, :, 0])
+    h = np.minimum(boxes[:, None, 3], others[None, :, 3]) - np.maximum(boxes[:, None, 1], others[None, :, 1])
+    return np.clip(w, 0, None) * np.clip(h, 0, None)
+
+def overlap_ratio(boxes, others):
+    """(N, M) share of the area of every box covered by every other box
+
+    Same value as ``highlights.areaCriteria(box, other)``; zero-area boxes get 0.
+
+    >>> overlap_ratio(as_boxes([(0, 0, 2, 2), (0, 0, 0, 0)]), as_boxes([(1, 0, 3, 2)])).tolist()
+    [[0.5], [0.0]]
+    """
+    area = box_area(boxes)[:, None]
+    inter = intersection_area(boxes, others)
+    return np.divide(inter, area, out=np.zeros_like(inter), where=area > 0)
+
+def covered(boxes, others, threshold=0.5, chunk=4096):
+    """Whether more than threshold of each box is covered by one of the others
+
+    Evaluated chunk boxes at a time, so a page with many words and many
+    highlights never builds one huge (N, M) matrix.
+
+    >>> covered(as_boxes([(0, 0, 2, 2), (0, 0, 2, 2), (4, 4, 5, 5)]), as_boxes([(1, 0, 3, 2), (0, 0, 1.5, 2)])).tolist()
+    [True, True, False]
+    """
+    result = np.zeros(len(boxes), dtype=bool)
+    if len(boxes) == 0 or len(others) == 0:
+        return result
+    for st in range(0, len(boxes), chunk):
+        ratio = overlap_ratio(boxes[st:st+chunk], others)
+        result[st:st+chunk] = (ratio > threshold).any(axis=1)
+    return result
+
+def as_points(points):
+    """Stack points (fitz.Point or pairs of numbers) into an (N, 2) array
+    """
+    if len(points) == 0:
+        return np.zeros((0, 2), dtype=np.float64)
+    return np.array([tuple(point)[:2] for point in points], dtype=np.float64).reshape(-1, 2)
+
+def contains(boxes, points):
+    """(N, M) whether point n lies in box m, like fitz.Rect.contains(point)
+
+    >>> contains(as_boxes([(0, 0, 2, 2), (1, 1, 3, 3)]), as_points([(1, 1), (2, 2), (5, 5)])).tolist()
+    [[True, True], [False, True], [False, False]]
+    """
+    x, y = points[:, None, 0], points[:, None, 1]
+    return (boxes[None, :, 0] <= x) & (x < boxes[None, :, 2]) & \
+           (boxes[None, :, 1] <= y) & (y < boxes[None, :, 3])
+
+def first_match(mask):
+    """Index of the first True column of every row of mask, -1 if none
+
+    >>> first_match(np.array([[False, True, True], [False, False, False]])).tolist()
+    [1, -1]
+    """
+    if mask.shape[1] == 0:
+        return np.full(mask.shape[0], -1)
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), -1)
+
+def last_match(mask):
+    """Index of the last True column of every row of mask, -1 if none
+
+    >>> last_match(np.array([[True, True, False], [False, False, False]])).tolist()
+    [1, -1]
+    """
+    if mask.shape[1] == 0:
+        return np.full(mask.shape[0], -1)
+    return np.where(mask.any(axis=1), mask.shape[1] - 1 - mask[:, ::-1].argmax(axis=1), -1)
+
+def nearest_below(boxes, points):
+    """For every point, the box whose bottom-right corner is closest below it
+
+    Closest means the smallest vertical distance, then the smallest
+    horizontal distance. Boxes ending above the point are skipped; -1 if
+    every box does.
+
+    >>> nearest_below(as_boxes([(0, 0, 2, 2), (0, 0, 9, 5), (0, 0, 3, 5)]), as_points([(4, 3), (0, 9)])).tolist()
+    [2, -1]
+    """
+    best = np.full(len(points), -1)
+    if len(boxes) == 0:
+        return best
+    dy = boxes[None, :, 3] - points[:, None, 1]
+    dx = np.abs(boxes[None, :, 2] - points[:, None, 0])
+    below = dy >= 0
+    # Lexicographic (dy, dx): order by dy, ties broken by dx
+    dy = np.where(below, dy, np.inf)
+    min_dy = dy.min(axis=1, keepdims=True)
+    dx = np.where(below & (dy == min_dy), dx, np.inf)
+    found = below.any(axis=1)
+    best[found] = dx[found].argmin(axis=1)
+    return best
+
+def mendeley_to_fitz(boxes, page_rect):
+    """Boxes from Mendeley coordinates (origin bottom-left of the page) to PyMuPDF ones
+
+    The y axis is flipped against the page height, x is shifted by the left
+    of the page, and y0 <= y1 is restored.
+
+    >>> mendeley_to_fitz(as_boxes([(15, 10, 25, 30)]), (10, 0, 110, 100)).tolist()
+    [[5.0, 70.0, 15.0, 90.0]]
+    """
+    result = np.empty_like(boxes)
+    result[:, 0] = boxes[:, 0] - page_rect[0]
+    result[:, 2] = boxes[:, 2] - page_rect[0]
+    y0 = page_rect[3] - boxes[:, 3]
+    y1 = page_rect[3] - boxes[:, 1]
+    result[:, 1] = np.minimum(y0, y1)
+    result[:, 3] = np.maximum(y0, y1)
+    return result
+
+def mendeley_points_to_fitz(points, page_rect):
+    """Points from Mendeley coordinates to PyMuPDF ones, see mendeley_to_fitz
+
+    >>> mendeley_points_to_fitz(as_points([(15, 10)]), (10, 0, 110, 100)).tolist()
+    [[5.0, 90.0]]
+    """
+    result = np.empty_like(points)
+    result[:, 0] = points[:, 0] - page_rect[0]
+    result[:, 1] = page_rect[3] - points[:, 1]
+    return result
+
+def union_runs(boxes, keys):
+    """Union box of every run of consecutive boxes with the same key
+
+    E.g. the word boxes of a sentence with their line numbers give one box per line.
+
+    >>> union_runs(as_boxes([(0, 0, 1, 1), (2, 0, 3, 2), (0, 5, 1, 6)]), np.array([7, 7, 8])).tolist()
+    [[0.0, 0.0, 3.0, 2.0], [0.0, 5.0, 1.0, 6.0]]
+    """
+    if len(boxes) == 0:
+        return np.zeros((0, 4), dtype=np.float64)
+    starts = np.flatnonzero(np.diff(keys, prepend=keys[0] - 1))
+    result = np.empty((len(starts), 4), dtype=np.float64)
+    result[:, :2] = np.minimum.reduceat(boxes[:, :2], starts, axis=0)
+    result[:, 2:] = np.maximum.reduceat(boxes[:, 2:], starts, axis=0)
+    return result
@@ -3,7 +3,15 @@ import json
 import os
 from tqdm import tqdm
 import re
+import sys
+import traceback
+import multiprocessing
 import config as cfg
+import geometry as geo
+import pdfcache
+import numpy as np
+from document import Document
+from manifest import BuildManifest, file_hash, json_hash, code_version
 
 class PDFEncoder(json.JSONEncoder):
     """ Custom encoder for numpy data types """
@@ -12,240 +20,369 @@ class PDFEncoder(json.JSONEncoder):
             return obj.__repr__()
         return json.JSONEncoder.default(self, obj)
 
-def addHighlight(annotation_file, pdf_folder, output_folder):
+def run_jobs(func, jobs, workers=1, desc=None):
+    """Call func(*args) for every (name, args) in jobs, in a process pool if workers > 1
+
+    A job raising an exception is reported and skipped, the others go on.
+    Results come back (and the progress bar moves) in the order of jobs.
+
+    Returns:
+        list of (name, traceback string) of the failed jobs
+    """
+    failed = []
+    pbar = tqdm(total=len(jobs), desc=desc)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(_run_job, [(func, name, args) for name, args in jobs])
+    else:
+        pool = None
+        results = (_run_job((func, name, args)) for name, args in jobs)
+    for name, error in results:
+        if error is not None:
+            print("Failed:", name)
+            print(error)
+            failed.append((name, error))
+        pbar.update(1)
+    pbar.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if len(failed) > 0:
+        print("{} of {} files failed:".format(len(failed), len(jobs)), ", ".join(name for name, _ in failed))
+    return failed
+
+def _run_job(job):
+    func, name, args = job
+    try:
+        func(*args)
+        return name, None
+    except Exception:
+        return name, traceback.format_exc()
+
+def run_stale_jobs(func, jobs, workers, manifest, stage):
+    """run_jobs on the jobs whose output is not fresh in manifest
+
+    Args:
+        jobs: list of (name, args, output_file, fingerprint)
+        manifest: BuildManifest, or None to run every job
+    """
+    todo = [(name, args) for name, args, output_file, fingerprint in jobs
+            if manifest is None or not manifest.is_fresh(stage, name, fingerprint, output_file)]
+    if manifest is not None:
+        print("{}: {} of {} up to date".format(stage, len(jobs) - len(todo), len(jobs)))
+    failed = run_jobs(func, todo, workers)
+
+    if manifest is not None:
+        failed_names = set(name for name, _ in failed)
+        for name, _, _, fingerprint in jobs:
+            if name not in failed_names:
+                manifest.record(stage, name, fingerprint)
+        manifest.save()
+    return failed
+
+def highlights_version():
+    # Outputs are rebuilt when the code producing them changes, including
+    # the pdf extraction cache and the Document layout
+    return code_version(sys.modules[__name__], geo, pdfcache, sys.modules[Document.__module__])
+
+def addHighlight(annotation_file, pdf_folder, output_folder, workers=1, manifest=None):
     data = {}
     with open(annotation_file, "r", encoding="utf-8") as f:
         data = json.load(f)
 
-    pbar = tqdm(total=len(data))
+    version = highlights_version()
+    jobs = []
     for doc in data:
         if doc['url'] is None:
-           continue 
-        doc_id = doc["doc_id"]
-        highlights = {}
-        texts = {}
-        for annot in doc["annots"]:
-            if annot['type'] == 'highlight':
-                for pos in annot["positions"]:
-                    rect = fitz.Rect([pos["top_left"]["x"],
-                        pos["top_left"]["y"],
-                        pos["bottom_right"]["x"],
-                        pos["bottom_right"]["y"]])
-                    #if rect.getArea() > 1e-5:
-                    highlights.setdefault(pos["page"], []).append(rect)
-            else:
-                for pos in annot["positions"]:
-                    assert(pos["top_left"]["x"] == pos["bottom_right"]["x"])
-                    assert(pos["top_left"]["y"] == pos["bottom_right"]["y"])
-                    point = fitz.Point(pos["top_left"]["x"], pos["top_left"]["y"])
-                    texts.setdefault(pos["page"], []).append((point, annot["text"]))
-        
-        pdf = fitz.open(os.path.join(pdf_folder, doc_id+".pdf"))
-        # print(doc_id)
-        pcnt = 1
-        for page in pdf:
-            # page_rect = page.bound()
-            page_rect = page.mediabox
-            # print(pcnt)
-            if pcnt in highlights and len(highlights[pcnt]) > 0:
-                # print(json.dumps(highlights[pcnt], indent=2, cls=PDFEncoder))
-                for rect in highlights[pcnt]:
-                    # Transform from mendeley to pymupdf
-                    rect[1], rect[3] = page_rect[3] - rect[3], page_rect[3] - rect[1]
-                    rect[0], rect[2] = rect[0] - page_rect[0], rect[2] - page_rect[0]
-                    if rect[1] > rect[3]:
-                        rect[1], rect[3] = rect[3], rect[1]
-                    page.add_highlight_annot(rect)
-            if pcnt in texts and len(texts[pcnt]) > 0:
-                # print(json.dumps(texts[pcnt], indent=2, cls=PDFEncoder))
-                for point, text in texts[pcnt]:
-                    point[1] = page_rect[3] - point[1]
-                    point[0] = point[0] - page_rect[0]
-                    page.add_text_annot(point, text)
-            
-            pcnt += 1
-        
-        pdf.save(os.path.join(output_folder, doc_id+".pdf"))
-        pdf.close()
-        pbar.update(1)
-        #break
-    pbar.close()
+            continue
+        pdf_file = os.path.join(pdf_folder, doc["doc_id"]+".pdf")
+        fingerprint = {
+            'pdf': file_hash(pdf_file) if os.path.exists(pdf_file) else None,
+            'annots': json_hash(doc["annots"]),
+            'code': version
+        }
+        jobs.append((doc["doc_id"], (doc, pdf_folder, output_folder),
+                     os.path.join(output_folder, doc["doc_id"]+".pdf"), fingerprint))
+    return run_stale_jobs(highlight_doc, jobs, workers, manifest, 'hl_pdf')
 
-def addPredHighlight(pdf_file, output_file, predicted, debug=True):
-    from itertools import chain
-    pdf = fitz.open(pdf_file)
-    pcnt = 0
+def highlight_doc(doc, pdf_folder, output_folder):
+    """Add the mendeley annotations of doc (one entry of annot.json) to its pdf
+    """
+    doc_id = doc["doc_id"]
+    highlights = {}
+    texts = {}
+    for annot in doc["annots"]:
+        if annot['type'] == 'highlight':
+            # The rects of one highlight on a page become the quads of one annotation
+            quads = {}
+            for pos in annot["positions"]:
+                rect = fitz.Rect([pos["top_left"]["x"],
+                    pos["top_left"]["y"],
+                    pos["bottom_right"]["x"],
+                    pos["bottom_right"]["y"]])
+                #if rect.getArea() > 1e-5:
+                quads.setdefault(pos["page"], []).append(rect)
+            for page_no, rects in quads.items():
+                highlights.setdefault(page_no, []).append(rects)
+        else:
+            for pos in annot["positions"]:
+                assert(pos["top_left"]["x"] == pos["bottom_right"]["x"])
+                assert(pos["top_left"]["y"] == pos["bottom_right"]["y"])
+                point = fitz.Point(pos["top_left"]["x"], pos["top_left"]["y"])
+                texts.setdefault(pos["page"], []).append((point, annot["text"]))
+
+    pdf = fitz.open(os.path.join(pdf_folder, doc_id+".pdf"))
+    # print(doc_id)
+    pcnt = 1
     for page in pdf:
-        hl = predicted[pcnt]
-        for label, sent, sent_rect in hl:
-            if debug:
-                print(sent)
-            
-            # Add highight in word level
-            # for rect in sent_rect:
-            #     page.add_highlight_annot(fitz.Rect(rect))
-
-            # Add highlight in line level (Put rects in the same line into a big rect)
-            lrect, pline = fitz.Rect(sent_rect[0][0][0]), sent_rect[0][0][1]
-            for rect, line in chain.from_iterable(sent_rect):
-                if line == pline:
-                    lrect.includeRect(fitz.Rect(rect))
-                else:
-                    page.add_highlight_annot(lrect)
-                    lrect = fitz.Rect(rect)
-                    pline = line
-            page.add_highlight_annot(lrect)
+        # page_rect = page.bound()
+        page_rect = page.mediabox
+        # print(pcnt)
+        if pcnt in highlights and len(highlights[pcnt]) > 0:
+            # print(json.dumps(highlights[pcnt], indent=2, cls=PDFEncoder))
+            for rects in highlights[pcnt]:
+                # Transform from mendeley to pymupdf
+                boxes = geo.mendeley_to_fitz(geo.as_boxes(rects), page_rect)
+                page.add_highlight_annot(quads=[fitz.Rect(*box) for box in boxes])
+        if pcnt in texts and len(texts[pcnt]) > 0:
+            # print(json.dumps(texts[pcnt], indent=2, cls=PDFEncoder))
+            points = geo.mendeley_points_to_fitz(geo.as_points([point for point, _ in texts[pcnt]]), page_rect)
+            for point, (_, text) in zip(points, texts[pcnt]):
+                page.add_text_annot(fitz.Point(*point), text)
 
         pcnt += 1
-    pdf.save(output_file)
+
+    save_pdf(pdf, os.path.join(output_folder, doc_id+".pdf"))
     pdf.close()
 
+def save_pdf(pdf, output_file):
+    """Save an open pdf, incrementally if it is written back to its own file
+
+    Otherwise the file is rewritten with unused objects removed and streams
+    compressed (PDF_SAVE_GARBAGE, PDF_SAVE_DEFLATE in config.py).
+    """
+    if os.path.abspath(output_file) == os.path.abspath(pdf.name) and pdf.can_save_incrementally():
+        pdf.saveIncr()
+    else:
+        pdf.save(output_file, garbage=cfg.PDF_SAVE_GARBAGE, deflate=cfg.PDF_SAVE_DEFLATE)
+
+def sentence_quads(doc, sent_ids):
+    """Line boxes of the sentences sent_ids of doc (a Document)
+
+    The word boxes of a sentence on the same line are merged into one box
+    per line.
+
+    Returns:
+        list of (page, (n_lines, 4) array), one per sentence
+    """
+    pages = doc.sentence_pages()
+    return [(int(pages[j]), geo.union_runs(*doc.sentence_boxes(j))) for j in sent_ids]
+
+def write_highlights(pdf_file, output_file, highlights):
+    """Add one multi-quad highlight annotation per (page, boxes) of highlights and save
+
+    Only plain arrays come in, so a pool of workers can write a directory
+    of predictions, each opening one pdf at a time.
+    """
+    by_page = {}
+    for p, boxes in highlights:
+        by_page.setdefault(p, []).append(boxes)
+    pdf = fitz.open(pdf_file)
+    for p in sorted(by_page):
+        page = pdf[p]
+        for boxes in by_page[p]:
+            page.add_highlight_annot(quads=[fitz.Rect(*box) for box in boxes])
+    save_pdf(pdf, output_file)
+    pdf.close()
+
+def addPredHighlight(pdf_file, output_file, doc, sent_ids, debug=True):
+    """Highlight the sentences sent_ids of doc (a Document of pdf_file), one annotation per sentence
+    """
+    if debug:
+        for j in sent_ids:
+            print(doc.sentence(j))
+    write_highlights(pdf_file, output_file, sentence_quads(doc, sent_ids))
+
 def areaCriteria(rect1, rect2):
-    rect = fitz.Rect(rect1)
-    rect.intersect(rect2)
-    
-    ac = rect.getArea()
-    a1 = rect1.getArea()
-    return ac / a1
-
-def word_concat(page_block):
-    result_block = []
-    size = len(page_block)
-    result_block.append(page_block[0])
-    for i in range(1, size):
-        label, text, box = page_block[i]
-        plabel, ptext, pbox = page_block[i-1]
-        line = box[0][1]
-        pline = pbox[0][1]
-        if ptext.endswith('-') and line == pline+1:
-            # Concat word
-            result_block.pop()
-            text = ptext[:-1] + text
-            label = label or plabel
-            box = [pbox[0], box[0]]
-        
-        result_block.append((label, text, box))
-    
-    return result_block
+    # Share of rect1 covered by rect2, see geometry.overlap_ratio for whole pages
+    return float(geo.overlap_ratio(geo.as_boxes([rect1]), geo.as_boxes([rect2]))[0, 0])
+
+def word_concat(texts, blocks, lines):
+    """Find the words hyphenated across lines
+
+    Word i continues word i-1 if both are in the same block, word i-1 ends
+    with '-' and word i is on the next line. The two are then one word:
+    the text of i-1 without the '-' followed by the text of i.
+
+    Returns:
+        bool array, True for the words i that absorb word i-1
+
+    >>> word_concat(['a', 'con-', 'cat', 'x-', 'y'], np.array([0, 0, 0, 0, 1]), np.array([0, 0, 1, 1, 2])).tolist()
+    [False, False, True, False, False]
+    """
+    merged = np.zeros(len(texts), dtype=bool)
+    if len(texts) > 1:
+        hyphen = np.array([text.endswith('-') for text in texts[:-1]])
+        merged[1:] = hyphen & (blocks[1:] == blocks[:-1]) & (lines[1:] == lines[:-1] + 1)
+    return merged
+
+def build_document(texts, pages, blocks, lines, boxes, labels, n_pages):
+    """Document of the words of a pdf, one box per word as extracted
+
+    Words hyphenated across lines (see word_concat) become one word with
+    both boxes and, if either is labeled, the label of the second one or
+    else the first. blocks must be unique across pages.
+    """
+    merged = word_concat(texts, blocks, lines)
+    # A word absorbed into the next one is dropped, the next one keeps both boxes
+    dropped = np.zeros(len(texts), dtype=bool)
+    dropped[:-1] = merged[1:]
+    keep = ~dropped
+    box_src = keep.copy()
+    box_src[:-1] |= merged[1:] & keep[1:]
+
+    words = [texts[i-1][:-1] + texts[i] if merged[i] else texts[i] for i in np.flatnonzero(keep)]
+    labels = np.asarray(labels)
+    prev_labels = np.roll(labels, 1)
+    labels = np.where(merged & (labels == 0), prev_labels, labels)[keep]
+    box_ptr = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum(1 + merged[keep], out=box_ptr[1:])
+    box_src = np.flatnonzero(box_src)
+    return Document(words, pages[keep], blocks[keep], labels, box_ptr,
+                    boxes[box_src], lines[box_src], n_pages)
 
 def doc2word(pdf_file):
-    pdf = fitz.open(pdf_file)
+    """Document (without sentences) of the words of a pdf, labeled by its highlights
+    """
+    pdf = pdfcache.load(pdf_file, cfg.pdf_cache_folder)
+    word_ptr = pdf.arrays['word_ptr']
+    pages = np.repeat(np.arange(len(pdf), dtype=np.int32), np.diff(word_ptr))
 
-    doc_words = []
-    for page in pdf:
-        # Get rect of annoataions
-        annots = []
-        for annot in page.annots():
-            if annot.type[1] == 'Highlight':
-                annots.append(annot.rect)
-        
-        # Get words
-        # Assume words appearing in reading order (Usually holds for a science paper)
-        words = page.get_text('words')
-
-        page_words = []
-        page_block = []
-        block_no = -1
-        for word in words:
-            rect = word[:4]
-            text = word[4]  # No '\t' or '\n' will be in text
-            # Block separated
-            block = word[5]
-            # Use line info to concatenate word cross line
-            line = word[6]
-            if block != block_no:
-                block_no = block
-                if len(page_block) > 0:
-                    page_block = word_concat(page_block)
-                    page_words.append(page_block)
-                    page_block = []
-            
-            label = int(any([(areaCriteria(fitz.Rect(rect), annot_rect) > 0.5) for annot_rect in annots]))
-            page_block.append((label, text, [(rect, line)]))
-        
-        if len(page_block) > 0:
-            page_block = word_concat(page_block)
-            page_words.append(page_block)
-            page_block = []
-        
-        doc_words.append(page_words)
+    # Labels of all words of a page at once
+    labels = np.zeros(len(pages), dtype=np.int8)
+    for p in range(len(pdf)):
+        annots, _ = pdf.page_highlight_quads(p)
+        boxes, _, _, _ = pdf.page_words(p)
+        labels[word_ptr[p]:word_ptr[p+1]] = geo.covered(boxes, annots, 0.5)
 
-    pdf.close()
-    return doc_words
-
-def sent_tokenize(texts):
-    sent_end = (".", "?", "!")
-    doc_sents = []
-    sent = []
-    for word in texts:
-        sent.append(word)
-        if word.endswith(sent_end):
-            # Exceptional case rules:
-            if len(re.findall(r'[Ff]ig(?:ure)?', word)) != 0:
-                continue
-            if len(sent) <= 2 or (len(word) == 2 and not word[0].isnumeric()):
-                continue
-            if word == 'al.':
-                continue
-            doc_sents.append(" ".join(sent))
-            sent = []
-    if sent != []:
-        doc_sents.append(" ".join(sent))
-    return doc_sents
-
-def word2sentence(doc_words):
-    pages = len(doc_words)
-    doc_sents = []
-    for page_words in doc_words:
-        page_sents = []
-        for block in page_words:
-            labels, texts, rects = zip(*block)
-            sents = sent_tokenize(texts)
-            
-            word_count = 0
-            for sent in sents:
-                words = sent.split(' ')
-                num_words = len(words)
-
-                label = int(any(labels[word_count:word_count+num_words]))
-                sent_rect = rects[word_count:word_count+num_words]
-                page_sents.append((label, sent, sent_rect))
-
-                # print(sent)
-                # print(texts[word_count:word_count+num_words])
-                # print('')
-
-                word_count += num_words
-            assert(word_count == len(texts))
-        doc_sents.append(page_sents)
-        
-    return doc_sents
+    # Assume words appearing in reading order (Usually holds for a science paper)
+    # No '\t' or '\n' will be in text
+    return build_document(pdf.word_text, pages, document_blocks(pages, pdf.arrays['word_block']),
+                          pdf.arrays['word_line'], pdf.arrays['word_boxes'], labels, len(pdf))
+
+def document_blocks(pages, blocks):
+    """Number the blocks of all pages 0, 1, ... in reading order
+
+    >>> document_blocks(np.array([0, 0, 0, 1, 1]), np.array([0, 0, 1, 0, 0])).tolist()
+    [0, 0, 1, 2, 2]
+    """
+    changed = np.zeros(len(pages), dtype=np.int32)
+    changed[1:] = (pages[1:] != pages[:-1]) | (blocks[1:] != blocks[:-1])
+    return np.cumsum(changed, dtype=np.int32)
+
+# Sentence segmentation rules. A word ends a sentence if it ends with one of
+# SENT_END, unless it mentions a figure, is 'al.' or is a 2-char word not
+# starting with a digit (e.g. 'A.', 'e.'), and the sentence has > 2 words.
+SENT_END = (".", "?", "!")
+FIGURE = re.compile(r'[Ff]ig')   # Same hits as [Ff]ig(?:ure)?
+
+def ends_sentence(word):
+    """Whether word can end a sentence, the rules that do not depend on context
+
+    >>> [ends_sentence(word) for word in ['end.', 'Fig.', 'al.', 'A.', '1.', 'why?', 'no']]
+    [True, False, False, False, True, True, False]
+    """
+    return word.endswith(SENT_END) and word != 'al.' and \
+        not (len(word) == 2 and not word[0].isnumeric()) and FIGURE.search(word) is None
+
+def sent_tokenize(texts, blocks=None):
+    """Word ranges of the sentences of all blocks of a document in one call
+
+    The candidate ends come from one pass of ends_sentence over all words,
+    then only the candidates and block starts are walked to apply the
+    minimum sentence length. Sentences never cross blocks.
+
+    Args:
+        texts: list of words
+        blocks: block id of every word (consecutive words of a block share
+            it), None if all words are one block
+
+    Returns:
+        starts, ends: int arrays, sentence j is texts[starts[j]:ends[j]]
+
+    >>> starts, ends = sent_tokenize(['We', 'did', 'it.', 'See', 'Fig.', '1.', 'Ok', 'so', 'on.'], [0, 0, 0, 0, 0, 0, 1, 1, 1])
+    >>> starts.tolist(), ends.tolist()
+    ([0, 3, 6], [3, 6, 9])
+    """
+    n = len(texts)
+    candidates = [i for i, word in enumerate(texts) if ends_sentence(word)]
+    if blocks is None or n == 0:
+        block_starts = [0] if n > 0 else []
+    else:
+        blocks = np.asarray(blocks)
+        block_starts = np.flatnonzero(np.diff(blocks, prepend=blocks[0] - 1)).tolist()
+    block_ends = block_starts[1:] + [n]
+
+    starts, ends = [], []
+    k = 0
+    for bst, bed in zip(block_starts, block_ends):
+        st = bst
+        while k < len(candidates) and candidates[k] < bed:
+            i = candidates[k]
+            k += 1
+            # Sentences are longer than 2 words
+            if i - st >= 2:
+                starts.append(st)
+                ends.append(i + 1)
+                st = i + 1
+        if st < bed:
+            starts.append(st)
+            ends.append(bed)
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+def word2sentence(doc):
+    """Split every block of doc into sentences, see Document.set_sentences
+    """
+    doc.set_sentences(*sent_tokenize(doc.words(), doc.word_block))
+    return doc
+
+def pdf2tsv(pdf_file, tsv_file):
+    """Write the sentences of a highlighted pdf with their labels to tsv_file
+    """
+    doc = word2sentence(doc2word(pdf_file))
+
+    with open(tsv_file, "w", encoding="utf-8") as f:
+        for label, sent in zip(doc.sentence_labels().tolist(), doc.sentences()):
+            f.write(str(label) + '\t' + sent)
+            f.write('\n')
+
+def addTSV(pdf_folder, output_folder, workers=1, manifest=None):
+    """pdf2tsv on every pdf of pdf_folder, writing <name>.tsv to output_folder
+    """
+    version = highlights_version()
+    jobs = []
+    for file in os.listdir(pdf_folder):
+        pdf_file = os.path.join(pdf_folder, file)
+        tsv_file = os.path.join(output_folder, file+'.tsv')
+        fingerprint = {'pdf': file_hash(pdf_file), 'code': version}
+        jobs.append((file, (pdf_file, tsv_file), tsv_file, fingerprint))
+    return run_stale_jobs(pdf2tsv, jobs, workers, manifest, 'tsv')
 
 def main(genPDF=False, genTSV=False):
+    # Only the documents whose pdf, annotations or code changed are rebuilt
+    manifest = BuildManifest(cfg.build_manifest_file) if cfg.INCREMENTAL_BUILD else None
+
     if genPDF:
         print('Generating highlighted pdf from mendeley...')
         if not os.path.exists(cfg.hl_pdf_folder):
             os.makedirs(cfg.hl_pdf_folder)
-        addHighlight(cfg.annotation_file, cfg.pdf_download_path, cfg.hl_pdf_folder)
+        addHighlight(cfg.annotation_file, cfg.pdf_download_path, cfg.hl_pdf_folder, cfg.HIGHLIGHT_WORKERS, manifest)
 
     if not os.path.exists(cfg.dataset_folder):
         os.makedirs(cfg.dataset_folder)
 
     if genTSV:
-        files = os.listdir(cfg.hl_pdf_folder)
-        pbar = tqdm(total=len(files))
-        for file in files:
-            doc_words = doc2word(os.path.join(cfg.hl_pdf_folder, file))
-            doc_sents = word2sentence(doc_words)
-
-            with open(os.path.join(cfg.dataset_folder, file+'.tsv'), "w", encoding="utf-8") as f:
-                for page_sents in doc_sents:
-                    for label, sent, _ in page_sents:
-                        f.write(str(label) + '\t' + sent)
-                        f.write('\n')
-            
-            pbar.update(1)
-        pbar.close()
+        addTSV(cfg.hl_pdf_folder, cfg.dataset_folder, cfg.HIGHLIGHT_WORKERS, manifest)
 
 
 if __name__ == '__main__':
@@ -1,49 +1,127 @@
 import config as cfg
 import json
 import os
+import pickle
+import multiprocessing
 from model import *
 from main import process_file
+from manifest import file_hash, json_hash, code_version
+import lemmatizer
 import sklearn
+import sklearn.metrics
+
+def read_tsv(tsv_file):
+    labels, texts = [], []
+    with open(tsv_file, 'r', encoding="utf-8") as f:
+        for Line in f:
+            if len(Line) > 5:
+                labels.append(int(Line[0]))
+                texts.append(Line[1:].strip())
+    return labels, texts
+
+def feature_version():
+    """What raw features depend on besides the text: the stopwords, the
+    units, CoreNLP, SciBERT and the code computing them
+    """
+    return {'stopwords': file_hash(cfg.stopword_path), 'units': file_hash(cfg.unit_file),
+            'corenlp': cfg.CORENLP_VERSION, 'scibert': cfg.USE_SCIBERT,
+            'code': code_version(pre, lemmatizer)}
+
+def doc_features(model, tsv_file):
+    """Raw per-sentence features (feature.raw_features) of one dataset TSV
+
+    Cached in loo_cache_folder by the hash of the TSV content and of
+    everything the features depend on (see feature_version), so they are
+    computed once per document, not once per fold.
+
+    Returns:
+        labels, raw features, and the (v, DF) counts of the document
+    """
+    key = json_hash({'tsv': file_hash(tsv_file), 'features': feature_version()})
+    cache_file = os.path.join(cfg.loo_cache_folder, key + '.pickle')
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+
+    labels, texts = read_tsv(tsv_file)
+    if model.processor is None:
+        model.open_processors()
+    features = pre.raw_features(texts, **model.processor, **model.meta)
+    counts = pre.count_voc_df([feature[1] for feature in features])
+    with open(cache_file, 'wb') as f:
+        pickle.dump((labels, features, counts), f)
+    return labels, features, counts
+
+# Per-document features of all folds, set in each fold worker by
+# init_fold_worker
+_docs = {}
+
+def init_fold_worker(docs):
+    global _docs
+    _docs = docs
+
+def run_fold(leave_one):
+    """Train on every document but leave_one and score on leave_one
+
+    IDF comes from the cached per-document counts, the training matrix is
+    the cached raw features of the other documents finalized with that IDF.
+    """
+    names = [name for name in _docs if name != leave_one]
+    v, DF = pre.merge_voc_df([_docs[name][2] for name in names])
+    v, DF = pre.drop_low_freq(v, DF)
+    labels, features = [], []
+    for name in names:
+        labels.extend(_docs[name][0])
+        features.extend(_docs[name][1])
+
+    model = SVM()
+    model.meta['IDF'] = pre.idf_from_df(DF, len(features))
+    model.fit_features(pre.feature_finalize(features, model.meta['IDF']), labels, grid_search=False)
+
+    # Calculate PR
+    test_labels, test_features, _ = _docs[leave_one]
+    predicts = model.predict_features(pre.feature_finalize(test_features, model.meta['IDF']))
+    score = (sklearn.metrics.precision_score(test_labels, predicts), sklearn.metrics.recall_score(test_labels, predicts))
+    return leave_one, score, model
 
 def main():
     tsvs = os.listdir(cfg.dataset_folder)
-    scores = {}
+    if not os.path.exists(cfg.loo_cache_folder):
+        os.makedirs(cfg.loo_cache_folder)
+
+    print("Extracting features...")
+    processor_model = SVM()
+    docs = {}
+    for name in tsvs:
+        print(name)
+        docs[name] = doc_features(processor_model, os.path.join(cfg.dataset_folder, name))
+    # Don't fork with the CoreNLP server, HDF5 and SQLite handles open
+    if processor_model.processor is not None:
+        processor_model.close_processors()
+
+    print("Training folds...")
+    scores, models = {}, {}
+    # Passed explicitly, workers started by spawn/forkserver inherit nothing
+    with multiprocessing.Pool(cfg.LOO_WORKERS, initializer=init_fold_worker, initargs=(docs,)) as pool:
+        for leave_one, score, model in pool.imap_unordered(run_fold, tsvs):
+            print(leave_one, score)
+            scores[leave_one], models[leave_one] = score, model
+
+    # Generate Output, all fold models share one set of processors
+    if not os.path.exists(cfg.output_folder):
+        os.makedirs(cfg.output_folder)
+    processor_model.open_processors()
     for leave_one in tsvs:
-        print(leave_one)
-        with open(cfg.train_tsv_file, "w", encoding="utf-8") as writer:
-            for other in tsvs:
-                if other == leave_one:
-                    continue
-                with open(os.path.join(cfg.dataset_folder, other), "r", encoding="utf-8") as f:
-                    writer.write(f.read())
-        
-        model = SVM()
-        model.preprocessing(cfg.train_tsv_file)
-        save_model(model, cfg.model_file)
-        # Reload
-        model = load_model(cfg.model_file)
-        model.train(grid_search=False)
-        # save_model(model, cfg.model_file)
-
-        # Calculate PR
-        labels, texts = [], []
-        with open(os.path.join(cfg.dataset_folder, leave_one), 'r') as f: 
-            for Line in f:
-                if len(Line) > 5: 
-                    labels.append(int(Line[0]))
-                    texts.append(Line[1:].strip())
-        
-        predicts = model.predict(texts)
-        scores[leave_one] = (sklearn.metrics.precision_score(labels, predicts), sklearn.metrics.recall_score(labels, predicts))
-
-        # Generate Output
+        model = models[leave_one]
+        model.processor = processor_model.processor
         pdf_name = ".".join(leave_one.split(".")[:-1])
         pdf_file = os.path.join(cfg.input_folder, pdf_name)
         output_file = os.path.join(cfg.output_folder, pdf_name)
         process_file(model, pdf_file, output_file)
-    
+    processor_model.close_processors()
+
     with open("report.json", "w", encoding="utf-8") as f:
-        json.dump(scores, f, indent=2)
+        json.dump({leave_one: scores[leave_one] for leave_one in tsvs}, f, indent=2)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
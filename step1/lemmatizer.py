@@ -0,0 +1,229 @@
+import json
+import hashlib
+import sqlite3
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+import stanfordcorenlp
+
+# Put between sentences of a batch. Input text is lower-cased by
+# manual_tune_pre, so the sentinel can never come from a real sentence.
+SENTINEL = 'AUTOSCHOLARSENTINEL'
+SEPARATOR = '\n\n' + SENTINEL + '\n\n'
+
+class BatchLemmatizer:
+    """Lemmatize many sentences per request to a StanfordCoreNLP server
+
+    Sentences are packed into one annotate call, separated by a sentinel on its
+    own paragraph. With ``ssplit.newlineIsSentenceBreak=two`` the separator is
+    always a sentence of its own, so every input sentence is split and tagged
+    exactly as if it were sent alone, and the response can be cut back per
+    input at the sentinel sentences.
+
+    Up to ``inflight`` batches are sent at the same time over a pooled
+    keep-alive session.
+
+    Args:
+        nlp_handler: stanfordcorenlp.StanfordCoreNLP instance, or the server url
+        batch_size: max sentences per request
+        max_chars: max characters per request (the server default limit is 100000)
+        inflight: number of concurrent requests
+    """
+    def __init__(self, nlp_handler, batch_size=64, max_chars=50000, inflight=4, lang='en'):
+        self.nlp_handler = nlp_handler
+        self.batch_size = batch_size
+        self.max_chars = max_chars
+        self.inflight = inflight
+        self.lang = lang
+        self.session = None
+        self.pool = None
+
+    @property
+    def url(self):
+        if isinstance(self.nlp_handler, str):
+            return self.nlp_handler
+        return self.nlp_handler.url
+
+    def open(self):
+        # Resolved here, not in __init__, so a lazy handler is only started when needed
+        lang = self.lang if isinstance(self.nlp_handler, str) else self.nlp_handler.lang
+        properties = {
+            'annotators': 'lemma',
+            'outputFormat': 'json',
+            'ssplit.newlineIsSentenceBreak': 'two'
+        }
+        self.params = {'properties': json.dumps(properties), 'pipelineLanguage': lang}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.inflight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers=self.inflight)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def lemma(self, texts):
+        """Same as feature.lemma_func on every text, in far fewer requests
+
+        Returns:
+            list with one [(word, lemma), ...] list per text
+        """
+        if len(texts) == 0:
+            return []
+        if self.session is None:
+            self.open()
+        results = []
+        for batch_result in self.pool.map(self._annotate, self._batches(texts)):
+            results.extend(batch_result)
+        assert(len(results) == len(texts))
+        return results
+
+    def _batches(self, texts):
+        batch, chars = [], 0
+        for text in texts:
+            if len(batch) > 0 and (len(batch) >= self.batch_size or
+                                   chars + len(text) > self.max_chars):
+                yield batch
+                batch, chars = [], 0
+            batch.append(text)
+            chars += len(text) + len(SEPARATOR)
+        if len(batch) > 0:
+            yield batch
+
+    def _annotate(self, batch):
+        data = SEPARATOR.join(batch).encode('utf-8')
+        r = self.session.post(self.url, params=self.params, data=data)
+        r.raise_for_status()
+        r_dict = json.loads(r.text)
+
+        results = [[]]
+        for s in r_dict['sentences']:
+            if len(s['tokens']) == 1 and s['tokens'][0]['originalText'] == SENTINEL:
+                results.append([])
+                continue
+            for token in s['tokens']:
+                results[-1].append((token['originalText'], token['lemma']))
+        if len(results) != len(batch):
+            raise ValueError("CoreNLP returned {} sentences for a batch of {}".format(len(results), len(batch)))
+        return results
+
+class LazyCoreNLP:
+    """stanfordcorenlp.StanfordCoreNLP that starts the Java server on first use
+
+    Attribute access is forwarded to the real handler, which is created the
+    first time something (e.g. ``url`` or ``_request``) is needed. A run whose
+    sentences are all in the LemmaCache never starts the server.
+    """
+    def __init__(self, path_or_host, **kwargs):
+        self.path_or_host = path_or_host
+        self.kwargs = kwargs
+        self._handler = None
+
+    @property
+    def started(self):
+        return self._handler is not None
+
+    @property
+    def handler(self):
+        if self._handler is None:
+            self._handler = stanfordcorenlp.StanfordCoreNLP(self.path_or_host, **self.kwargs)
+        return self._handler
+
+    def __getattr__(self, name):
+        if name in ('path_or_host', 'kwargs', '_handler'):
+            raise AttributeError(name)
+        return getattr(self.handler, name)
+
+    def close(self):
+        if self._handler is not None:
+            self._handler.close()
+            self._handler = None
+
+class LemmaCache:
+    """Disk-backed cache of CoreNLP lemmas, keyed by normalized sentence text
+
+    The key is the sha1 of the version tag and the ``manual_tune_pre`` output,
+    so upgrading CoreNLP (a new tag) never returns stale lemmas. Entries live
+    in a SQLite table, the most recently used ``memory_size`` are also kept in
+    memory.
+
+    Args:
+        path: SQLite file
+        version: CoreNLP version tag
+        memory_size: max entries kept in memory (LRU)
+    """
+    def __init__(self, path, version, memory_size=100000):
+        self.path = path
+        self.version = version
+        self.memory_size = memory_size
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS lemmas (key TEXT PRIMARY KEY, lemmas TEXT)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def key(self, text):
+        return hashlib.sha1((self.version + '\n' + text).encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        """Lemma lists of texts (already manual_tune_pre'd), None where not cached
+        """
+        keys = [self.key(text) for text in texts]
+        found = {}
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+
+        lookup = list(set(keys) - set(found))
+        CHUNK = 500 # SQLite limits the number of bound variables
+        for st in range(0, len(lookup), CHUNK):
+            chunk = lookup[st:st+CHUNK]
+            rows = self.db.execute("SELECT key, lemmas FROM lemmas WHERE key IN ({})".format(
+                ",".join("?" * len(chunk))), chunk)
+            for key, lemmas in rows:
+                found[key] = json.loads(lemmas)
+                self._remember(key, found[key])
+
+        results = [found.get(key) for key in keys]
+        self.misses += results.count(None)
+        self.hits += len(results) - results.count(None)
+        return results
+
+    def put_many(self, texts, lemmas_list):
+        rows = []
+        for text, lemmas in zip(texts, lemmas_list):
+            key = self.key(text)
+            self._remember(key, lemmas)
+            rows.append((key, json.dumps(lemmas)))
+        self.db.executemany("INSERT OR REPLACE INTO lemmas VALUES (?, ?)", rows)
+        self.db.commit()
+
+    def _remember(self, key, lemmas):
+        self.memory[key] = lemmas
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -2,26 +2,50 @@ import highlights as hl
 from model import *
 import config as cfg
 import os
+import numpy as np
+
+def predict_sentences(clf, sents):
+    """clf.predict over a long list of sentences, PREDICT_BATCH_SIZE at a time
+    """
+    labels = []
+    for st in range(0, len(sents), cfg.PREDICT_BATCH_SIZE):
+        labels.extend(clf.predict(sents[st:st+cfg.PREDICT_BATCH_SIZE]))
+    return labels
+
+def process_files(clf, jobs, debug=True):
+    """Highlight the predicted sentences of several PDFs
+
+    The sentences of all pages of all files are gathered and predicted in
+    large batches, then the labels are split back per file.
+
+    Args:
+        jobs: list of (pdf_file, output_file)
+    """
+    docs = [hl.word2sentence(hl.doc2word(pdf_file)) for pdf_file, _ in jobs]
+    sents = []
+    for doc in docs:
+        sents.extend(doc.sentences())
+
+    labels = np.asarray(predict_sentences(clf, sents))
+
+    # The pdfs are written by a pool, each worker gets only the line boxes
+    write_jobs = []
+    st = 0
+    for (pdf_file, output_file), doc in zip(jobs, docs):
+        sent_ids = np.flatnonzero(labels[st:st+doc.n_sents] == 1)
+        st += doc.n_sents
+        if debug:
+            print(pdf_file, "Num of sentences to highlight:", len(sent_ids))
+            for j in sent_ids:
+                print(doc.sentence(j))
+
+        if len(sent_ids) > 0:
+            write_jobs.append((pdf_file, (pdf_file, output_file, hl.sentence_quads(doc, sent_ids))))
+
+    hl.run_jobs(hl.write_highlights, write_jobs, min(cfg.HIGHLIGHT_WORKERS, len(write_jobs)))
 
 def process_file(clf, pdf_file, output_file, debug=True):
-    doc_words = hl.doc2word(pdf_file)
-    doc_sents = hl.word2sentence(doc_words)
-
-    predicted = []
-    cnt = 0
-    for page_sents in doc_sents:
-        label, sent, sent_rect = zip(*page_sents)
-        label = clf.predict(sent)
-        
-        hl_sents = [(label[i], sent[i], sent_rect[i]) for i in range(len(label)) if label[i] == 1]
-        predicted.append(hl_sents)
-        cnt += len(hl_sents)
-    
-    if debug:
-        print("Num of sentences to highlight:", cnt)
-
-    if cnt > 0:
-        hl.addPredHighlight(pdf_file, output_file, predicted, debug)
+    process_files(clf, [(pdf_file, output_file)], debug)
 
 def main():
     files = os.listdir(cfg.input_folder)
@@ -30,15 +54,21 @@ def main():
     if not os.path.exists(cfg.output_folder):
         os.makedirs(cfg.output_folder)
 
+    jobs = []
     for file in files:
         if not file.endswith(".pdf"):
             continue
-        print("Processing...", file)
         pdf_file = os.path.join(cfg.input_folder, file)
         output_file = os.path.join(cfg.output_folder, file)
-        process_file(clf, pdf_file, output_file, debug=True)
+        jobs.append((pdf_file, output_file))
+
+    # Several files per batch, the sentences of a batch are predicted together
+    for st in range(0, len(jobs), cfg.PREDICT_FILES_PER_BATCH):
+        batch = jobs[st:st+cfg.PREDICT_FILES_PER_BATCH]
+        print("Processing...", ", ".join(os.path.basename(pdf_file) for pdf_file, _ in batch))
+        process_files(clf, batch, debug=True)
 
     clf.close_processors()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
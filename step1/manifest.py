@@ -0,0 +1,60 @@
+import os
+import json
+import hashlib
+
+def file_hash(path, chunk_size=1 << 20):
+    """sha1 hex digest of the content of a file
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def json_hash(obj):
+    """sha1 hex digest of a JSON-serializable object, independent of key order
+
+    >>> json_hash({'a': 1, 'b': [2]}) == json_hash({'b': [2], 'a': 1})
+    True
+    """
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+def code_version(*modules):
+    """Hash of the source files of modules, changes whenever their code does
+    """
+    h = hashlib.sha1()
+    for module in modules:
+        with open(module.__file__, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+class BuildManifest:
+    """Fingerprints of the inputs each output was built from, kept in a JSON file
+
+    Outputs are grouped by stage (e.g. 'hl_pdf', 'tsv') and named by a key
+    (e.g. the doc_id). A fingerprint is a dict of hashes, usually of the input
+    files, the annotations and the code. An output is fresh if it exists and
+    its recorded fingerprint equals the current one, i.e. rebuilding it
+    would give the same file.
+
+    Deleting the manifest file forces a full rebuild.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def is_fresh(self, stage, key, fingerprint, output_file):
+        return os.path.exists(output_file) and self.entries.get(stage, {}).get(key) == fingerprint
+
+    def record(self, stage, key, fingerprint):
+        self.entries.setdefault(stage, {})[key] = fingerprint
+
+    def save(self):
+        # Write then rename, an interrupted run never leaves a broken manifest
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.path)
@@ -0,0 +1,107 @@
+import os
+import json
+import numpy as np
+from scipy import sparse
+
+class CSRAppender:
+    """Build a CSR matrix on disk, one block of rows at a time
+
+    ``data`` and ``indices`` of every appended block go straight to raw files
+    in folder, only the row pointer (one int per row) stays in memory.
+    ``matrix()`` returns the result with memory-mapped data and indices.
+
+    Args:
+        folder: existing directory for the data.bin/indices.bin files
+        n_cols: number of columns
+    """
+    def __init__(self, folder, n_cols):
+        self.folder = folder
+        self.n_cols = n_cols
+        self.data_file = os.path.join(folder, 'data.bin')
+        self.indices_file = os.path.join(folder, 'indices.bin')
+        self.data = open(self.data_file, 'wb')
+        self.indices = open(self.indices_file, 'wb')
+        self.indptr = [np.zeros(1, dtype=np.int64)]
+        self.nnz = 0
+        self.n_rows = 0
+
+    def append(self, X):
+        X = sparse.csr_matrix(X)
+        assert(X.shape[1] == self.n_cols)
+        X.sort_indices()
+        X.data.astype(np.float64).tofile(self.data)
+        X.indices.astype(np.int32).tofile(self.indices)
+        self.indptr.append(X.indptr[1:].astype(np.int64) + self.nnz)
+        self.nnz += X.nnz
+        self.n_rows += X.shape[0]
+
+    def close(self):
+        if not self.data.closed:
+            self.data.close()
+            self.indices.close()
+
+    def matrix(self, mode='r'):
+        """The appended rows as a csr_matrix over memory maps of the files
+
+        mode: 'r+' to modify the values in place, e.g., for scaling
+        """
+        self.close()
+        if self.nnz == 0:
+            return sparse.csr_matrix((self.n_rows, self.n_cols))
+        data = np.memmap(self.data_file, dtype=np.float64, mode=mode, shape=(self.nnz,))
+        indices = np.memmap(self.indices_file, dtype=np.int32, mode='r', shape=(self.nnz,))
+        indptr = np.concatenate(self.indptr)
+        return sparse.csr_matrix((data, indices, indptr), shape=(self.n_rows, self.n_cols), copy=False)
+
+# Preprocessed dataset: a folder with one raw .npy file per array and a JSON
+# header, so it can be opened with mmap_mode instead of being unpickled.
+#   header.json  {"version", "sparse", "shape", "dtype", "arrays"}
+#   y.npy        labels
+#   X.npy        dense features, or
+#   X_data.npy, X_indices.npy, X_indptr.npy   CSR features
+DATASET_VERSION = 1
+
+def save_dataset(folder, X, y):
+    """Save features X (ndarray or scipy sparse) and labels y to folder
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    is_sparse = sparse.issparse(X)
+    if is_sparse:
+        X = sparse.csr_matrix(X)
+        arrays = {'X_data': X.data, 'X_indices': X.indices, 'X_indptr': X.indptr}
+    else:
+        arrays = {'X': np.asarray(X)}
+    arrays['y'] = np.asarray(y)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(folder, name + '.npy'), np.ascontiguousarray(array))
+    header = {
+        'version': DATASET_VERSION,
+        'sparse': is_sparse,
+        'shape': list(X.shape),
+        'dtype': str(X.dtype),
+        'arrays': sorted(arrays)
+    }
+    with open(os.path.join(folder, 'header.json'), 'w', encoding='utf-8') as f:
+        json.dump(header, f, indent=2)
+
+def load_dataset(folder, mmap_mode='r'):
+    """Open a dataset saved by save_dataset, memory-mapped by default
+
+    Returns:
+        X: np.memmap, or csr_matrix over memory-mapped arrays
+        y: np.memmap
+    """
+    with open(os.path.join(folder, 'header.json'), 'r', encoding='utf-8') as f:
+        header = json.load(f)
+    if header['version'] != DATASET_VERSION:
+        raise ValueError("Unsupported dataset version {} in {}".format(header['version'], folder))
+    arrays = {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode=mmap_mode)
+              for name in header['arrays']}
+    if header['sparse']:
+        X = sparse.csr_matrix((arrays['X_data'], arrays['X_indices'], arrays['X_indptr']),
+                              shape=tuple(header['shape']), copy=False)
+    else:
+        X = arrays['X']
+    return X, arrays['y']
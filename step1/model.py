@@ -5,6 +5,7 @@ import pickle
 import sklearn
 import config as cfg
 import numpy as np
+from scipy import sparse
 import random
 from sklearn import preprocessing, model_selection
 from sklearn.ensemble import RandomForestClassifier
@@ -12,6 +13,12 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.neural_network import MLPClassifier
 from sklearn.svm import SVC
 from transformers import AutoTokenizer, AutoModel
+from embed_store import EmbeddingStore, EMBED_DIM
+from lemmatizer import BatchLemmatizer, LazyCoreNLP, LemmaCache
+from matrix_io import CSRAppender, save_dataset, load_dataset
+from tqdm import tqdm
+import tempfile
+import math
 import json
 
 class NumpyEncoder(json.JSONEncoder):
@@ -40,16 +47,62 @@ class NumpyEncoder(json.JSONEncoder):
 
         return json.JSONEncoder.default(self, obj)
 
+def count_labels(train_csv):
+    """Number of positive and negative lines of a training TSV
+    """
+    num_pos, num_neg = 0, 0
+    with open(train_csv, 'r') as f:
+        for Line in f:
+            if len(Line) > 5:
+                if int(Line[0]) == 1:
+                    num_pos += 1
+                else:
+                    num_neg += 1
+    return num_pos, num_neg
+
+def iter_tsv_chunks(train_csv, size):
+    """Yield (labels, texts) of a training TSV, size lines at a time
+    """
+    labels, texts = [], []
+    with open(train_csv, 'r') as f:
+        for Line in f:
+            if len(Line) > 5:
+                labels.append(int(Line[0]))
+                texts.append(Line[1:].strip())
+            if len(labels) == size:
+                yield labels, texts
+                labels, texts = [], []
+    if len(labels) > 0:
+        yield labels, texts
+
+class Reservoir:
+    """Uniform sample of k items from a stream of unknown length (algorithm R)
+    """
+    def __init__(self, k):
+        self.k = k
+        self.seen = 0
+        self.items = []
+
+    def add(self, item):
+        if len(self.items) < self.k:
+            self.items.append(item)
+        else:
+            j = random.randrange(self.seen + 1)
+            if j < self.k:
+                self.items[j] = item
+        self.seen += 1
+
 class SVM:
     def init(self):
         self.processor = None
         self.meta = {
             'stopwords': set(open(cfg.stopword_path, 'r').read().split()),
-            'units': open(cfg.unit_file, 'r').read().split(),
+            'units': pre.TokenClassifier(open(cfg.unit_file, 'r').read().split()),
             'IDF': None
         }
         self.clf = None
-        self.scaler = preprocessing.StandardScaler()
+        # Features are sparse, which can be scaled but not centered
+        self.scaler = preprocessing.StandardScaler(with_mean=False)
 
     def __init__(self):        
         self.init()
@@ -74,60 +127,138 @@ class SVM:
 
     def open_processors(self):
         self.processor = {}
-        self.processor['nlp'] = stanfordcorenlp.StanfordCoreNLP(cfg.stanfordcorenlp_jar_location)
+        # The Java server is only started if some sentence misses the lemma cache
+        self.processor['nlp'] = LazyCoreNLP(cfg.stanfordcorenlp_jar_location)
+        self.processor['lemmatizer'] = BatchLemmatizer(self.processor['nlp'], cfg.CORENLP_BATCH_SIZE,
+                                                       inflight=cfg.CORENLP_INFLIGHT)
+        self.processor['lemma_cache'] = LemmaCache(cfg.LEMMA_CACHE_DB, cfg.CORENLP_VERSION,
+                                                   cfg.LEMMA_CACHE_MEMORY)
         if cfg.USE_SCIBERT:
             self.processor['tokenizer'] = AutoTokenizer.from_pretrained('allenai/scibert_scivocab_uncased')
             self.processor['model'] = AutoModel.from_pretrained('allenai/scibert_scivocab_uncased')
+            self.processor['store'] = EmbeddingStore(cfg.SCIBERT_DB, cfg.SCIBERT_BATCH_SIZE)
         else:
             self.processor['tokenizer'] = None
             self.processor['model'] = None
+            self.processor['store'] = None
     
     def close_processors(self):
+        self.processor['lemmatizer'].close()
+        cache = self.processor['lemma_cache']
+        print("Lemma cache: {} hits, {} misses".format(cache.hits, cache.misses))
+        cache.close()
         self.processor['nlp'].close()
+        if self.processor['store'] is not None:
+            store = self.processor['store']
+            print("SciBERT store: {} hits, {} misses".format(store.hits, store.misses))
+            store.close()
         del self.processor['nlp']
+        del self.processor['lemmatizer']
+        del self.processor['lemma_cache']
         del self.processor['tokenizer']
         del self.processor['model']
+        del self.processor['store']
         self.processor = None
 
     def preprocessing(self, train_csv):
-        labels, texts = [], []
+        """Build the training set from a TSV of (label, sentence) lines
+
+        The result is saved to preprocessed_folder (see matrix_io.save_dataset).
+        The corpus is streamed in chunks of PREPROCESS_CHUNK_SIZE lines, so
+        memory does not grow with its size:
+            0. count positive and negative lines
+            1. document frequencies of all lines, and a reservoir sample of
+               NEGATIVE_RATIO negatives per positive
+            2. features of the positives and sampled negatives, appended to an
+               on-disk CSR matrix, while the scaler is fit with partial_fit on
+               every line (SciBERT columns on the sampled lines only)
+        """
         print("Loading...")
-        with open(train_csv, 'r') as f: 
-            for Line in f:
-                if len(Line) > 5: 
-                    labels.append(int(Line[0]))
-                    texts.append(Line[1:].strip())
-        
-        # Pre-Processing
+        num_pos, num_neg = count_labels(train_csv)
+        num_neg_sample = min(num_pos * cfg.NEGATIVE_RATIO, num_neg)
+
         print('Pre-Processing...')
         self.open_processors()
-        features, self.meta['IDF'] = pre.build_features(texts, **self.processor, **self.meta)
-        self.close_processors() 
-        
-        # Standardization
-        vectors_scaled = self.scaler.fit_transform(features)
-        X, y = sklearn.utils.shuffle(vectors_scaled, labels)
-        
-        y = np.array(y)
-        pos, neg = np.where(y == 1), np.where(y == 0)
-        X_pos, y_pos = X[pos], y[pos]
-        X_neg, y_neg = X[neg], y[neg]
-        num_neg = np.min([len(y_pos) * cfg.NEGATIVE_RATIO, len(y_neg)])
-        # Sample part of the negative samples
-        neg_sample = random.sample(range(len(y_neg)), num_neg) 
-        y_neg = y_neg[neg_sample]
-        X_neg = X_neg[neg_sample]
-        X = np.vstack([X_pos, X_neg])
-        y = np.concatenate([y_pos, y_neg])
-        X, y = sklearn.utils.shuffle(X, y)
-        
-        with open(cfg.preprocessed_file, "wb") as f:
-            pickle.dump( (X, y), f)
+        # Pass 1, no embedding is needed for document frequencies
+        pass1 = dict(self.processor, model=None)
+        v, DF = pre.count_voc_df([])
+        neg_sample = Reservoir(num_neg_sample)
+        st = 0
+        for labels, texts in tqdm(iter_tsv_chunks(train_csv, cfg.PREPROCESS_CHUNK_SIZE),
+                                  total=math.ceil((num_pos + num_neg) / cfg.PREPROCESS_CHUNK_SIZE)):
+            if cfg.FEATURE_WORKERS > 1:
+                _, chunk_v, chunk_DF = pre.parallel_raw_features(texts, workers=cfg.FEATURE_WORKERS,
+                                                                 **pass1, **self.meta)
+            else:
+                features = pre.raw_features(texts, **pass1, **self.meta)
+                chunk_v, chunk_DF = pre.count_voc_df([feature[1] for feature in features])
+            v, DF = pre.merge_voc_df([(v, DF), (chunk_v, chunk_DF)])
+            for i, label in enumerate(labels):
+                if label == 0:
+                    neg_sample.add(st + i)
+            st += len(labels)
+
+        v, DF = pre.drop_low_freq(v, DF)
+        self.meta['IDF'] = pre.idf_from_df(DF, num_pos + num_neg)
+
+        # Pass 2
+        selected = set(neg_sample.items)
+        y = []
+        with tempfile.TemporaryDirectory(dir='.') as scratch:
+            writer = None
+            st = 0
+            for labels, texts in iter_tsv_chunks(train_csv, cfg.PREPROCESS_CHUNK_SIZE):
+                keep = [i for i, label in enumerate(labels) if label == 1 or st + i in selected]
+                rest = [i for i, label in enumerate(labels) if not (label == 1 or st + i in selected)]
+                st += len(labels)
+                if len(keep) > 0:
+                    features = pre.convert_features([texts[i] for i in keep], **self.processor, **self.meta)
+                    if writer is None:
+                        writer = CSRAppender(scratch, features.shape[1])
+                    self.scaler.partial_fit(features)
+                    writer.append(features)
+                    y.extend(labels[i] for i in keep)
+                if len(rest) > 0:
+                    # The scaler is fit on every line, not only the sampled ones.
+                    # The other lines skip SciBERT, their embedding columns are
+                    # NaN, which partial_fit leaves out
+                    features = pre.convert_features([texts[i] for i in rest], **pass1, **self.meta)
+                    if self.processor['model'] is not None:
+                        features = sparse.hstack([features, np.full((len(rest), EMBED_DIM), np.nan)], format='csr')
+                    self.scaler.partial_fit(features)
+            self.close_processors()
+
+            # Standardization, in place on disk
+            X = writer.matrix(mode='r+')
+            scale = 1.0 / self.scaler.scale_
+            for st in range(0, X.nnz, cfg.PREPROCESS_CHUNK_SIZE * 100):
+                en = st + cfg.PREPROCESS_CHUNK_SIZE * 100
+                X.data[st:en] *= scale[X.indices[st:en]]
+            X, y = sklearn.utils.shuffle(X, np.array(y))
+
+        save_dataset(cfg.preprocessed_folder, X, y)
 
     def train(self, grid_search=True):
-        X, y = None, None
-        with open(cfg.preprocessed_file, "rb") as f:
-            X, y = pickle.load(f)
+        # Memory-mapped, grid search workers share the pages
+        X, y = load_dataset(cfg.preprocessed_folder)
+        self.fit(X, y, grid_search)
+
+    def fit_features(self, features, labels, grid_search=False):
+        """Train from in-memory finalized features, e.g., for cross validation
+
+        Standardization and negative sampling are the same as preprocessing.
+        """
+        X = self.scaler.fit_transform(features)
+        y = np.array(labels)
+        pos, neg = np.flatnonzero(y == 1), np.flatnonzero(y == 0)
+        num_neg = min(len(pos) * cfg.NEGATIVE_RATIO, len(neg))
+        # Sample part of the negative samples
+        neg_sample = neg[random.sample(range(len(neg)), num_neg)]
+        rows = np.concatenate([pos, neg_sample])
+        X, y = sklearn.utils.shuffle(X[rows], y[rows])
+        self.fit(X, y, grid_search)
+
+    def fit(self, X, y, grid_search=True):
         # Training
         print("Training...")
         CORE_NUM = 6
@@ -152,6 +283,9 @@ class SVM:
             self.open_processors()
         
         features = pre.convert_features(texts, **self.meta, **self.processor)
+        return self.predict_features(features)
+
+    def predict_features(self, features):
         X = self.scaler.transform(features)
         y = self.clf.predict(X)
         return y
@@ -1,9 +1,100 @@
+import os
+import sys
+import argparse
+import multiprocessing
 import fitz
+import pdfcache
 
-def pdf2txt(fname):
-    with fitz.open(fname) as doc: # open document
-        text_list = [page.get_text() for page in doc]
-    return "\n\n".join(text_list)
+PAGE_SEPARATOR = "\n\n"
+
+def pdf2txt(fname, cache_folder=None):
+    """Text of every page of a pdf, separated by PAGE_SEPARATOR
+
+    cache_folder: read the text from the pdfcache there (extracting the
+    whole pdf once), None to only read the page texts from the pdf
+    """
+    if cache_folder is None:
+        return PAGE_SEPARATOR.join(iter_pages(fname))
+    doc = pdfcache.load(fname, cache_folder)
+    text_list = [doc.page_text(p) for p in range(len(doc))]
+    return PAGE_SEPARATOR.join(text_list)
+
+def _page_texts(job):
+    # Every worker opens the pdf itself, read-only
+    fname, st, ed = job
+    with fitz.open(fname) as doc:
+        return [doc[p].get_text() for p in range(st, ed)]
+
+def iter_pages(fname, workers=1, pages_per_job=8):
+    """Yield the text of every page of a pdf, in order, as soon as it is extracted
+
+    With workers > 1 the pages are split into runs of pages_per_job, which
+    are extracted by a process pool.
+    """
+    with fitz.open(fname) as doc:
+        n_pages = len(doc)
+        if workers <= 1:
+            for page in doc:
+                yield page.get_text()
+            return
+
+    jobs = [(fname, st, min(st + pages_per_job, n_pages)) for st in range(0, n_pages, pages_per_job)]
+    with multiprocessing.Pool(workers) as pool:
+        for texts in pool.imap(_page_texts, jobs):
+            yield from texts
+
+def write_txt(fname, out=None, workers=1):
+    """Stream the text of a pdf (same as pdf2txt) to out, a file name or a text file object
+
+    out: None for stdout
+    """
+    pages = iter_pages(fname, workers)
+    # A broken pdf fails here, before the output file is created
+    first = next(pages, None)
+    f = sys.stdout if out is None else out
+    if isinstance(out, str):
+        f = open(out, 'w', encoding='utf-8')
+    try:
+        if first is not None:
+            f.write(first)
+        for text in pages:
+            f.write(PAGE_SEPARATOR)
+            f.write(text)
+    finally:
+        if isinstance(out, str):
+            f.close()
+
+def _convert(job):
+    fname, out = job
+    try:
+        write_txt(fname, out)
+        return fname, None
+    except Exception as e:
+        return fname, repr(e)
+
+def convert_folder(pdf_folder, txt_folder, workers=1):
+    """<name>.txt in txt_folder for every <name>.pdf in pdf_folder, one pdf per worker
+
+    Returns:
+        list of (pdf file, error) of the pdfs that failed
+    """
+    if not os.path.exists(txt_folder):
+        os.makedirs(txt_folder)
+    jobs = [(os.path.join(pdf_folder, file), os.path.join(txt_folder, file[:-4] + '.txt'))
+            for file in sorted(os.listdir(pdf_folder)) if file.lower().endswith('.pdf')]
+    with multiprocessing.Pool(max(workers, 1)) as pool:
+        failed = [(fname, error) for fname, error in pool.imap_unordered(_convert, jobs) if error is not None]
+    for fname, error in failed:
+        print("Failed:", fname, error, file=sys.stderr)
+    return failed
 
 if __name__ == '__main__':
-    print(pdf2txt("C:/Users/NKWBTB/Desktop/2022.naacl-main.175.pdf").encode("utf-8"))
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Extract the text of a pdf, or of every pdf of a folder")
+    parser.add_argument('input', help='pdf file or folder of pdfs')
+    parser.add_argument('-o', '--output', default=None, help='txt file (default: stdout), or folder for a folder input')
+    parser.add_argument('--workers', type=int, default=1, help='processes: pages of a pdf, or pdfs of a folder')
+    args = parser.parse_args()
+    if os.path.isdir(args.input):
+        convert_folder(args.input, args.output or args.input, args.workers)
+    else:
+        write_txt(args.input, args.output, args.workers)
@@ -0,0 +1,172 @@
+import os
+import hashlib
+import numpy as np
+import fitz
+from manifest import file_hash
+
+# Extracted content of a pdf, one .npz per file named by the hash of the pdf.
+# Per-page items are stored flat, items of page p are [ptr[p], ptr[p+1]):
+#   page_text                                 get_text() of every page
+#   word_ptr, word_boxes (N, 4), word_block, word_line, word_text
+#                                             get_text('words') of every page
+#   highlight_ptr, highlight_boxes, highlight_content
+#                                             'Highlight' annotations
+#   highlight_quad_ptr, highlight_quads       one box per quad (line) of each of
+#                                             them, items of highlight i are
+#                                             [quad_ptr[i], quad_ptr[i+1])
+#   note_ptr, note_boxes, note_content        'Text' annotations
+# Strings (*_text, *_content) are packed by pack_strings.
+CACHE_VERSION = 2
+
+def pack_strings(strings):
+    """Pack strings into a utf-8 buffer and the character offsets of each one
+
+    >>> buffer, offsets = pack_strings(['ab', '', 'cé'])
+    >>> offsets.tolist()
+    [0, 2, 2, 4]
+    >>> unpack_strings(buffer, offsets)
+    ['ab', '', 'cé']
+    """
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+    buffer = np.frombuffer("".join(strings).encode('utf-8'), dtype=np.uint8)
+    return buffer, offsets
+
+def unpack_strings(buffer, offsets):
+    text = buffer.tobytes().decode('utf-8')
+    return [text[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+
+def annot_quads(annot):
+    """One box per quad of a (multi-line) highlight annotation
+
+    annot.rect is the union of the quads plus some padding. Every quad box
+    gets the same padding, so a single-quad highlight gives annot.rect.
+    """
+    rect = tuple(annot.rect)
+    vertices = annot.vertices
+    if not vertices or len(vertices) <= 4 or len(vertices) % 4 != 0:
+        return [rect]
+    points = np.array(vertices, dtype=np.float64).reshape(-1, 4, 2)
+    boxes = np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1)
+    pad = np.array(rect) - np.concatenate([boxes[:, :2].min(axis=0), boxes[:, 2:].max(axis=0)])
+    return [tuple(box) for box in (boxes + pad).tolist()]
+
+def extract(pdf_file):
+    """Read the text, words and annotations of every page of a pdf into arrays
+    """
+    page_text = []
+    words, word_ptr = [], [0]
+    highlights, highlight_content, highlight_ptr = [], [], [0]
+    quads, quad_ptr = [], [0]
+    notes, note_content, note_ptr = [], [], [0]
+    with fitz.open(pdf_file) as pdf:
+        for page in pdf:
+            page_text.append(page.get_text())
+            words.extend(page.get_text('words'))
+            word_ptr.append(len(words))
+            for annot in page.annots():
+                content = annot.info.get('content', '') or ''
+                if annot.type[1] == 'Highlight':
+                    highlights.append(tuple(annot.rect))
+                    highlight_content.append(content)
+                    quads.extend(annot_quads(annot))
+                    quad_ptr.append(len(quads))
+                elif annot.type[1] == 'Text':
+                    notes.append(tuple(annot.rect))
+                    note_content.append(content)
+            highlight_ptr.append(len(highlights))
+            note_ptr.append(len(notes))
+
+    arrays = {
+        'version': np.array(CACHE_VERSION),
+        'word_ptr': np.array(word_ptr, dtype=np.int64),
+        'word_boxes': np.array([word[:4] for word in words], dtype=np.float64).reshape(-1, 4),
+        'word_block': np.array([word[5] for word in words], dtype=np.int32),
+        'word_line': np.array([word[6] for word in words], dtype=np.int32),
+        'highlight_ptr': np.array(highlight_ptr, dtype=np.int64),
+        'highlight_boxes': np.array(highlights, dtype=np.float64).reshape(-1, 4),
+        'highlight_quad_ptr': np.array(quad_ptr, dtype=np.int64),
+        'highlight_quads': np.array(quads, dtype=np.float64).reshape(-1, 4),
+        'note_ptr': np.array(note_ptr, dtype=np.int64),
+        'note_boxes': np.array(notes, dtype=np.float64).reshape(-1, 4)
+    }
+    for name, strings in (('page_text', page_text), ('word_text', [word[4] for word in words]),
+                          ('highlight_content', highlight_content), ('note_content', note_content)):
+        arrays[name], arrays[name + '_offsets'] = pack_strings(strings)
+    return arrays
+
+class PDFData:
+    """Extracted content of a pdf (see extract), read page by page
+    """
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.word_text = unpack_strings(arrays['word_text'], arrays['word_text_offsets'])
+        self.highlight_content = unpack_strings(arrays['highlight_content'], arrays['highlight_content_offsets'])
+        self.note_content = unpack_strings(arrays['note_content'], arrays['note_content_offsets'])
+        self.page_texts = unpack_strings(arrays['page_text'], arrays['page_text_offsets'])
+
+    def __len__(self):
+        return len(self.arrays['word_ptr']) - 1
+
+    def _range(self, name, p):
+        ptr = self.arrays[name + '_ptr']
+        return ptr[p], ptr[p+1]
+
+    def page_text(self, p):
+        """page.get_text() of page p"""
+        return self.page_texts[p]
+
+    def page_words(self, p):
+        """page.get_text('words') of page p, as (boxes (N, 4), texts, blocks, lines)"""
+        st, ed = self._range('word', p)
+        return (self.arrays['word_boxes'][st:ed], self.word_text[st:ed],
+                self.arrays['word_block'][st:ed], self.arrays['word_line'][st:ed])
+
+    def page_highlights(self, p):
+        """Rects (N, 4) and contents of the highlight annotations of page p"""
+        st, ed = self._range('highlight', p)
+        return self.arrays['highlight_boxes'][st:ed], self.highlight_content[st:ed]
+
+    def page_highlight_quads(self, p):
+        """Quad boxes (N, 4) of the highlight annotations of page p, and the
+        index (among the highlights of the page) of the annotation of each"""
+        st, ed = self._range('highlight', p)
+        ptr = self.arrays['highlight_quad_ptr']
+        owners = np.repeat(np.arange(ed - st), np.diff(ptr[st:ed+1]))
+        return self.arrays['highlight_quads'][ptr[st]:ptr[ed]], owners
+
+    def page_notes(self, p):
+        """Rects (N, 4) and contents of the text annotations of page p"""
+        st, ed = self._range('note', p)
+        return self.arrays['note_boxes'][st:ed], self.note_content[st:ed]
+
+def cache_key(pdf_file):
+    # The extraction depends on the pdf, this layout and the PyMuPDF version
+    tag = "{}\n{}\n{}".format(file_hash(pdf_file), CACHE_VERSION, fitz.VersionBind)
+    return hashlib.sha1(tag.encode('utf-8')).hexdigest()
+
+def load(pdf_file, cache_folder=None):
+    """PDFData of pdf_file, extracted once and then read from cache_folder
+
+    Args:
+        cache_folder: folder of the .npz files, None to always extract
+    """
+    if cache_folder is None:
+        return PDFData(extract(pdf_file))
+
+    cache_file = os.path.join(cache_folder, cache_key(pdf_file) + '.npz')
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as f:
+            arrays = {name: f[name] for name in f.files}
+        if int(arrays['version']) == CACHE_VERSION:
+            return PDFData(arrays)
+
+    arrays = extract(pdf_file)
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder, exist_ok=True)
+    # Write then rename, so concurrent workers never read a partial file
+    tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_file, cache_file)
+    return PDFData(arrays)
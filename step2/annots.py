@@ -6,69 +6,53 @@ import numpy as np
 import sys
 from tqdm import tqdm
 sys.path.append('../step1')
-from highlights import word_concat, areaCriteria, sent_tokenize
+from highlights import build_document, document_blocks, word2sentence
+import geometry as geo
+import pdfcache
 
-def block2samples(page_block):
-    samples = []
-    labels, texts, rects = zip(*page_block)
-    sents = sent_tokenize(texts)
-        
-    word_count = 0
-    for sent in sents:
-        words = sent.split(' ')
-        num_words = len(words)
+def doc2samples(doc, label_names):
+    """(words, tags) of every sentence of doc with a tagged word
 
-        tags = labels[word_count:word_count+num_words]
-        if any(tags):
-            samples.append((words, tags))
-        
-        word_count += num_words
+    doc.word_label holds indices into label_names, 0 is the empty tag "".
+    """
+    samples = []
+    tagged = doc.sentence_labels()
+    for j in np.flatnonzero(tagged):
+        st, ed = doc.sent_start[j], doc.sent_end[j]
+        tags = tuple(label_names[t] for t in doc.word_label[st:ed].tolist())
+        samples.append((doc.words(st, ed), tags))
     
     return samples
 
 def parse_pdf(pdf_file):
-    pdf = fitz.open(pdf_file)
+    pdf = pdfcache.load(pdf_file, cfg.pdf_cache_folder)
     classSet = set()
-    samples = []
-    for page in pdf:
+    word_ptr = pdf.arrays['word_ptr']
+    pages = np.repeat(np.arange(len(pdf), dtype=np.int32), np.diff(word_ptr))
+    # Word labels as indices into the label names, 0 is no label
+    labels = np.zeros(len(pages), dtype=np.int32)
+    label_ids = {"": 0}
+    for p in range(len(pdf)):
         # Get rect of annoataions
+        # Every line (quad) of a highlight is a highlight of its own, the same
+        # as when each line was written as a separate annotation
+        quads, quad_owners = pdf.page_highlight_quads(p)
+        _, hl_contents = pdf.page_highlights(p)
         highlights = []
-        comments = []
-        for annot in page.annots():
-            # print(annot, annot.rect)
-            if annot.type[1] == 'Highlight':
-                highlights.append([annot.rect])
-                if 'content' in annot.info and len(annot.info['content']) > 0:
-                    highlights[-1].append(annot.info['content'])
-            elif annot.type[1] == 'Text':
-                comments.append((annot.info['content'], annot.rect.tl))
-        
-        size = len(highlights)
-        for text, point in comments:
-            # 1. Check whether point is in a Rect
-            found = False
-            for i in range(size):
-                rect = highlights[i][0]
-                if rect.contains(point):
-                    highlights[i].append(text)
-                    found = True
-                    break
-            if found:
-                continue
-            # 2. Give the text to the closest highlight(bottom right) below the point
-            '''
-            idx = 0
-            for i in range(size):
-                rect = highlights[i][0]
-                br = rect.br
-                if br.y >= point.y and \
-                    np.abs(br.y - point.y) <= np.abs(highlights[idx][0].br.y - point.y) and \
-                    np.abs(br.x - point.x) < np.abs(highlights[idx][0].br.x - point.x):
-                    idx = i
-            
-            highlights[idx].append(text)
-            '''
-        
+        for rect, owner in zip(quads, quad_owners):
+            highlights.append([fitz.Rect(*rect)])
+            if len(hl_contents[owner]) > 0:
+                highlights[-1].append(hl_contents[owner])
+        note_boxes, note_contents = pdf.page_notes(p)
+
+        # 1. Give each comment to the first highlight containing its (top left) point
+        owners = geo.first_match(geo.contains(quads, note_boxes[:, :2]))
+        for text, owner in zip(note_contents, owners):
+            if owner != -1:
+                highlights[owner].append(text)
+        # 2. (Disabled) Give the other texts to the closest highlight below the point,
+        # i.e. geo.nearest_below(quads, note_boxes[:, :2])
+
         # print(highlights)
         ## Test if texts are matched correctly        
         for hl in highlights:
@@ -82,48 +66,31 @@ def parse_pdf(pdf_file):
                 annot.set_opacity(0.5)
             '''
 
-        # Get words
-        # Assume words appearing in reading order (Usually holds for a science paper)
-        words = page.get_text('words')
+        # Label of a word: the last commented highlight covering more than half of it
+        boxes, _, _, _ = pdf.page_words(p)
+        commented = [i for i, hl in enumerate(highlights) if len(hl) > 1]
+        hl_labels = []
+        for i in commented:
+            label = highlights[i][1]
+            end = label.find(':')
+            if end != -1:
+                label = label[:end]
+            hl_labels.append(label.strip().lower())
+        matched = geo.overlap_ratio(boxes, quads[commented]) > 0.5
+        classSet.update(hl_labels[i] for i in np.flatnonzero(matched.any(axis=0)))
+        owners = geo.last_match(matched)
+        hl_ids = np.array([0] + [label_ids.setdefault(label, len(label_ids)) for label in hl_labels], dtype=np.int32)
+        labels[word_ptr[p]:word_ptr[p+1]] = hl_ids[owners + 1]
 
-        page_block = []
-        block_no = -1
-        for word in words:
-            rect = word[:4]
-            text = word[4]  # No '\t' or '\n' will be in text
-            # Block separated
-            block = word[5]
-            # Use line info to concatenate word cross line
-            line = word[6]
-            if block != block_no:
-                block_no = block
-                if len(page_block) > 0:
-                    page_block = word_concat(page_block)
-                    samples.extend(block2samples(page_block))
-                    page_block = []
-            
-            label = ""
-            for hl in highlights:
-                if len(hl) > 1:
-                    annot_rect = hl[0]
-                    if areaCriteria(fitz.Rect(rect), annot_rect) > 0.5:
-                        label = hl[1]
-                        end = label.find(':')
-                        if end != -1:
-                            label = label[:end]
-                        label = label.strip().lower()
-                        classSet.add(label)
-                        # print(text, ':::' ,label)
-            
-            page_block.append((label, text, [(rect, line)]))
-        
-        if len(page_block) > 0:
-            page_block = word_concat(page_block)
-            samples.extend(block2samples(page_block))
-            page_block = []
-        
-    # pdf.save('test.pdf')
-    pdf.close()
+    # Get words
+    # Assume words appearing in reading order (Usually holds for a science paper)
+    # Use line info to concatenate word cross line
+    doc = build_document(pdf.word_text, pages, document_blocks(pages, pdf.arrays['word_block']),
+                         pdf.arrays['word_line'], pdf.arrays['word_boxes'], labels, len(pdf))
+    doc = word2sentence(doc)
+    label_names = sorted(label_ids, key=label_ids.get)
+    samples = doc2samples(doc, label_names)
+    
     return samples, classSet
 
 
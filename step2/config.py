@@ -1,7 +1,8 @@
 annot_pdf_folder = "../step1/highlighted_pdfs/"
 dataset_folder = "./dataset/"
+pdf_cache_folder = "../step1/pdf_cache/"   # Shared with step1, see step1/pdfcache.py
 
 label_class_file = "class.txt"
-preprocessed_file = 'preprocessed.pickle'
+preprocessed_folder = './preprocessed/'   # See step1/matrix_io.save_dataset
 
 PADDING_LENGTH = 100
\ No newline at end of file
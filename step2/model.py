@@ -7,6 +7,9 @@ import config as cfg
 import sklearn
 import numpy as np
 import matplotlib.pyplot as plt
+import sys
+sys.path.append('../step1')
+from matrix_io import load_dataset
 
 class CharRNN():
     def __init__(self):
@@ -38,10 +41,7 @@ class CharRNN():
         self.model = keras.models.load_model(self.checkpoint_path)
 
     def train(self):
-        X, y = None, None
-        with open(cfg.preprocessed_file, "rb") as f:
-            X, y = pickle.load(f)
-            
+        X, y = load_dataset(cfg.preprocessed_folder)
         X, y = sklearn.utils.shuffle(X, y)
         '''
         size = len(y)
@@ -4,6 +4,9 @@ import numpy as np
 import config as cfg
 import pickle
 import random
+import sys
+sys.path.append('../step1')
+from matrix_io import save_dataset
 
 addBefore = 1
 addAfter = 1
@@ -76,5 +79,4 @@ if __name__ == '__main__':
     print(num_classes)
     print(len(X), num_classes[''] / len(X))
     '''
-    with open(cfg.preprocessed_file, "wb") as f:
-        pickle.dump((X, y), f)
+    save_dataset(cfg.preprocessed_folder, X, y)